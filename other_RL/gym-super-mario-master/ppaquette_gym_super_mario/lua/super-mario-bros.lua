@@ -9,6 +9,10 @@
 -- mode = "algo";           -- algo, human
 -- draw_tiles = "1";
 -- meta = "0"               -- meta indicates multiple mission
+-- persistent = "0"         -- persistent keeps fceux running at the end of the level, waiting for changelevel
+-- savestates = "0"         -- changelevel loads a savestate of the first controllable frame instead of replaying the intro
+-- compact = "0"            -- sends whole tile grids (grid_) and fixed data records (state_) instead of diffs
+-- channels = "";           -- what is sent to python (e.g. "tiles,distance"): screen, tiles and data fields, everything if empty
 -- pipe_name = "abc";
 -- pipe_prefix = "/tmp/smb-fifo";
 
@@ -24,6 +28,10 @@
 mode = mode or "algo";
 draw_tiles = tonumber(draw_tiles) or 0;
 meta = tonumber(meta) or 0;
+persistent = tonumber(persistent) or 0;
+savestates = tonumber(savestates) or 0;
+compact = tonumber(compact) or 0;
+channels = channels or "";
 pipe_name = pipe_name or "";
 pipe_prefix = pipe_prefix or "";
 
@@ -51,6 +59,7 @@ skip_data = 0;              -- Does not send data to pipe (e.g. human mode)
 skip_tiles = 0;             -- Does not send tiles to pipe (e.g. human mode)
 skip_commands = 0;          -- Do not read commands from pipe (e.g. human mode)
 start_delay = 100;          -- Number of frames to wait before pressing "start" to start level
+reset_frame = 0;            -- Frame of the last level change (start_delay is counted from it)
 send_all_pixels = 702;      -- Return full screen (all pixels) every 700 frames
 force_refresh = 0;          -- Forces to return full screen (all pixels and data) for this number of frames
 changing_level = 0;         -- Indicates level change in progress
@@ -65,6 +74,18 @@ pipe_in = nil;              -- Input named pipe
 pipe_out = nil;             -- Output named pipe
 running_thread = 0;         -- To avoid 2 threads running at the same time
 commands_rcvd = 0;          -- To indicate that commands were received
+level_states = {};          -- Savestate of the first controllable frame of each level (by target), if savestates is set
+gesp_grace = -1;            -- Grace time of the GESP check (set with the ref message), disabled if negative
+gesp_tolerance = 0;         -- Tolerance margin of the GESP check
+gesp_increment = 0;         -- Distance is rounded down to a multiple of this value in the GESP check, if positive
+gesp_ref = {};              -- Reference distance of each processed frame (indexed from 0)
+gesp_observed = {};         -- Distance of each processed frame of the episode (indexed from 0)
+gesp_t = -1;                -- Index of the last processed frame of the episode
+gesp_stopped = 0;           -- Indicates the episode was early stopped by the GESP check
+repeat_left = 0;            -- Processed frames left in the current chunk (commands with a repeat count)
+is_chunk = 0;               -- Indicates the last commands had a repeat count (the distance trace is sent at the end)
+chunk_trace = {};           -- Distance of each processed frame of the current chunk
+saved_states = {};          -- Savestates requested by python with the savestate message (by id)
 
 -- Max distances
 distances = {};
@@ -121,6 +142,21 @@ else
     send_all_pixels = 1500;
 end;
 
+-- Observation channels
+-- Only the requested screen, tiles and data fields are sent (is_finished is always sent)
+send_data = { distance = 1, life = 1, score = 1, coins = 1, time = 1, player_status = 1 };
+if channels ~= "" then
+    local requested = {};
+    for channel in string.gmatch(channels, "[^,]+") do
+        requested[channel] = 1;
+    end;
+    for field, _ in pairs(send_data) do
+        send_data[field] = requested[field] or 0;
+    end;
+    if nil == requested["screen"] then skip_screen = 1; end;
+    if nil == requested["tiles"] then skip_tiles = 1; end;
+end;
+
 -- ===========================
 --         Memory Address
 -- ===========================
@@ -177,6 +213,12 @@ function reset_vars()
     curr_y_position = 0;
     last_processed_frame = 0;
     max_distance = distances[target] or 0;
+    gesp_observed = {};
+    gesp_t = -1;
+    gesp_stopped = 0;
+    repeat_left = 0;
+    is_chunk = 0;
+    chunk_trace = {};
 end;
 
 -- round - Rounds a number to precision level
@@ -373,56 +415,67 @@ function get_data()
     local framecount = emu.framecount();
     local data_count = 0;
     local data_string = "";
-    local curr_life = get_life();
-    local curr_score = get_score();
-    local curr_coins = get_coins();
-    local curr_time = get_time();
-    local curr_player_status = get_player_status();
+    local curr_life = -1;
+    local curr_score = -1;
+    local curr_coins = -1;
+    local curr_time = -1;
+    local curr_player_status = -1;
+    if 1 == send_data["life"] then curr_life = get_life(); end;
+    if 1 == send_data["score"] then curr_score = get_score(); end;
+    if 1 == send_data["coins"] then curr_coins = get_coins(); end;
+    if 1 == send_data["time"] then curr_time = get_time(); end;
+    if 1 == send_data["player_status"] then curr_player_status = get_player_status(); end;
     
-    -- Checking what values have changed
-    if (framecount % send_all_pixels == 0) or (curr_x_position ~= data["distance"]) or (force_refresh > 0) then
+    -- Checking what values have changed (among the requested ones)
+    if (1 == send_data["distance"]) and ((framecount % send_all_pixels == 0) or (curr_x_position ~= data["distance"]) or (force_refresh > 0)) then
         data["distance"] = curr_x_position;
         data_string = data_string .. "|distance:" .. curr_x_position;
         data_count = data_count + 2;
     end;
-    if (framecount % send_all_pixels == 0) or (curr_life ~= data["life"]) or (force_refresh > 0) then
+    if (1 == send_data["life"]) and ((framecount % send_all_pixels == 0) or (curr_life ~= data["life"]) or (force_refresh > 0)) then
         data["life"] = curr_life;
         data_string = data_string .. "|life:" .. curr_life;
         data_count = data_count + 1;
     end;
-    if (framecount % send_all_pixels == 0) or (curr_score ~= data["score"]) or (force_refresh > 0) then
+    if (1 == send_data["score"]) and ((framecount % send_all_pixels == 0) or (curr_score ~= data["score"]) or (force_refresh > 0)) then
         data["score"] = curr_score;
         data_string = data_string .. "|score:" .. curr_score;
         data_count = data_count + 1;
     end;
-    if (framecount % send_all_pixels == 0) or (curr_coins ~= data["coins"]) or (force_refresh > 0) then
+    if (1 == send_data["coins"]) and ((framecount % send_all_pixels == 0) or (curr_coins ~= data["coins"]) or (force_refresh > 0)) then
         data["coins"] = curr_coins;
         data_string = data_string .. "|coins:" .. curr_coins;
         data_count = data_count + 1;
     end;
-    if (framecount % send_all_pixels == 0) or (curr_time ~= data["time"]) or (force_refresh > 0) then
+    if (1 == send_data["time"]) and ((framecount % send_all_pixels == 0) or (curr_time ~= data["time"]) or (force_refresh > 0)) then
         data["time"] = curr_time;
         data_string = data_string .. "|time:" .. curr_time;
         data_count = data_count + 1;
     end;
-    if (framecount % send_all_pixels == 0) or (curr_player_status ~= data["player_status"]) or (force_refresh > 0) then
+    if (1 == send_data["player_status"]) and ((framecount % send_all_pixels == 0) or (curr_player_status ~= data["player_status"]) or (force_refresh > 0)) then
         data["player_status"] = curr_player_status;
         data_string = data_string .. "|player_status:" .. curr_player_status;
         data_count = data_count + 1;
     end;
     if (framecount % send_all_pixels == 0) or (is_finished ~= data["is_finished"]) or (force_refresh > 0) then
         data["is_finished"] = is_finished;
-        data_string = data_string .. "|is_finished:" .. is_finished;
+        data_string = data_string .. "|is_finished:" .. is_finished .. "|gesp_stopped:" .. gesp_stopped;
         data_count = data_count + 1;
     end;
     
     -- Removing leading "|" if data has changed, otherwise not returning anything
     if data_count > 0 then
-        if is_finished == 1 then
+        local header = "data_";
+        if 1 == compact then
+            -- Fixed record with all the values, in this order
+            header = "state_";
+            data_string = "|" .. curr_x_position .. "," .. curr_life .. "," .. curr_score .. "," .. curr_coins .. "," .. curr_time .. "," .. curr_player_status .. "," .. is_finished .. "," .. gesp_stopped;
+        end;
+        if (is_finished == 1) and (0 == persistent) then
             -- Indicates to the listening thread to also exit after parsing command
             data_string = data_string .. "|exit";
         end;
-        write_to_pipe("data_" .. framecount .. "#" .. string.sub(data_string, 2, -1));
+        write_to_pipe(header .. framecount .. "#" .. string.sub(data_string, 2, -1));
     end;
     return;
 end;
@@ -463,6 +516,7 @@ end;
 -- get_tiles - Returns tiles data (and displays them on screen)
 -- Only returns tiles that have changed since last update
 -- Format: tiles_<frame_number>#<x(1 hex digits)><y (1 hex digits)><value (1 hex digits)>|...
+-- Compact format: grid_<frame_number>#<value of the 13 x 16 tiles, row by row (208 digits)>, sent if any tile has changed
 -- Value: 0 - Empty space, 1 - Object / Other, 2 - Enemy, 3 - Mario
 function get_tiles()
     
@@ -475,6 +529,8 @@ function get_tiles()
     local left_x = get_left_x_position();
     local y_viewport = get_y_viewport();
     local framecount = emu.framecount();
+    local grid = {};
+    local grid_changed = 0;
     
     -- Outside box (80 x 65 px)
     -- Will contain a matrix of 16x13 sub-boxes of 5x5 pixels each
@@ -540,16 +596,24 @@ function get_tiles()
                 -- Only returning value if tile value has changed (or full refresh needed)
                 if (framecount % send_all_pixels == 0) or (tile_value ~= tiles[(box_x / 16) + 7][(box_y / 16) + 4]) or (force_refresh > 0) then
                     tiles[(box_x / 16) + 7][(box_y / 16) + 4] = tile_value;
-                    --noinspection StringConcatenationInLoops
-                    tile_string = tile_string .. "|" .. string.format("%01x%01x%01x", (box_x / 16) + 7, (box_y / 16) + 4, tile_value);
-                    data_count = data_count + 1;
+                    if 1 == compact then
+                        grid_changed = 1;
+                    else
+                        --noinspection StringConcatenationInLoops
+                        tile_string = tile_string .. "|" .. string.format("%01x%01x%01x", (box_x / 16) + 7, (box_y / 16) + 4, tile_value);
+                        data_count = data_count + 1;
+                    end;
                 end;
+                grid[#grid + 1] = tile_value;
             end;
         end;
         if data_count > 0 then
             write_to_pipe("tiles_" .. framecount .. "#" .. string.sub(tile_string, 2, -1));
         end;
     end;
+    if grid_changed == 1 then
+        write_to_pipe("grid_" .. framecount .. "#" .. table.concat(grid));
+    end;
     return;
 end;
 
@@ -560,7 +624,7 @@ function check_if_started()
 
     -- Cannot start before 'start' is pressed
     local framecount = emu.framecount();
-    if (framecount < start_delay) then
+    if (framecount - reset_frame < start_delay) then
         return;
     end;
 
@@ -570,15 +634,11 @@ function check_if_started()
         if (last_time_left > time_left) then
             is_started = 1;
             last_time_left = 0;
-            pipe_out, _, _ = io.open(pipe_prefix .. "-in." .. pipe_name, "w");
-            write_to_pipe("ready_" .. emu.framecount());
-            force_refresh = 5;  -- Sending full screen for next 5 frames, then only diffs
-            update_positions();
-            show_curr_distance();
-            get_tiles();
-            get_data();
-            -- get_screen();    -- Was blocking execution
-            ask_for_commands();
+            if (1 == savestates) and (nil == level_states[target]) then
+                level_states[target] = savestate.create();
+                savestate.save(level_states[target]);
+            end;
+            send_ready();
         else
             last_time_left = time_left;
         end;
@@ -586,6 +646,19 @@ function check_if_started()
     return;
 end;
 
+-- send_ready - Tells python that the level can be played (first controllable frame)
+function send_ready()
+    pipe_out, _, _ = io.open(pipe_prefix .. "-in." .. pipe_name, "w");
+    write_to_pipe("ready_" .. emu.framecount());
+    force_refresh = 5;  -- Sending full screen for next 5 frames, then only diffs
+    update_positions();
+    show_curr_distance();
+    get_tiles();
+    get_data();
+    -- get_screen();    -- Was blocking execution
+    ask_for_commands();
+end;
+
 -- check_if_finished - Checks if the level is finished (life lost, finish line crossed, level increased)
 -- The target (reward_threshold) is 40 pixels before the castle
 -- The finish line (where the game will automatically close) is 15 pixels before the castle
@@ -599,22 +672,73 @@ function check_if_finished()
         is_started = 0;
         is_finished = 1;
 
+        -- Finished in the middle of a chunk, sending it now
+        if repeat_left > 0 then
+            send_frame();
+            return;
+        end;
+
         -- Processing manually last command
         read_commands();
         if commands_rcvd == 1 then
             commands_rcvd = 0
             emu.frameadvance();
             update_positions();
-            show_curr_distance();
-            get_tiles();
-            get_data();
-            get_screen();
-            ask_for_commands();
+            add_to_chunk_trace();
+            send_frame();
         end;
     end;
     return;
 end;
 
+-- add_to_chunk_trace - Stores the distance of the processed frame if the commands had a repeat count
+function add_to_chunk_trace()
+    if 1 == is_chunk then
+        chunk_trace[#chunk_trace + 1] = curr_x_position;
+    end;
+end;
+
+-- send_frame - Sends the data of the processed frame (and the distance trace of the chunk) and asks for commands
+-- Format: trace_<frame_number>#<distance_1>,<distance_2>,... (one per processed frame of the chunk)
+function send_frame()
+    if 1 == is_chunk then
+        write_to_pipe("trace_" .. emu.framecount() .. "#" .. table.concat(chunk_trace, ","));
+        is_chunk = 0;
+        repeat_left = 0;
+        chunk_trace = {};
+    end;
+    show_curr_distance();
+    get_tiles();
+    get_data();
+    get_screen();
+    ask_for_commands();
+end;
+
+-- check_gesp - Early stops the episode with the GESP rule (the same as GESPStopper.observe in python)
+-- Only if a reference was received with the ref message, called once per processed frame
+function check_gesp()
+    if gesp_grace < 0 then
+        return;
+    end;
+    gesp_t = gesp_t + 1;
+    local f = curr_x_position;
+    if gesp_increment > 0 then
+        f = f - (f % gesp_increment);
+    end;
+    gesp_observed[gesp_t] = f;
+    if (gesp_t < gesp_grace) or (nil == gesp_ref[gesp_t]) then
+        return;
+    end;
+    local t_prev = gesp_t - gesp_grace;
+    if math.max(f, gesp_observed[t_prev]) + gesp_tolerance < math.min(gesp_ref[gesp_t], gesp_ref[t_prev]) then
+        -- is_finished will be written to pipe with the get_data() function
+        gesp_stopped = 1;
+        is_started = 0;
+        is_finished = 1;
+    end;
+    return;
+end;
+
 -- ask_for_commands - Mark the current frame has processed (to listen for matching command)
 function ask_for_commands()
     local framecount = emu.framecount();
@@ -635,13 +759,22 @@ function read_commands()
     local line = pipe_in:read();
     if line ~= nil then
         parse_commands(line);
+    else
+        -- End of file: python closed the pipe or died
+        close_pipes();
+        os.exit();
     end;
     return;
 end;
 
 -- parse_commands() - Parse received commands
 -- Format: commands_<frame number>#up,left,down,right,a,b (e.g. commands_21345#0,0,0,1,1,0)
+-- Format: commands_<frame number>#up,left,down,right,a,b,repeat (same commands for the next <repeat> processed frames)
 -- Format: changelevel#<level_number> (e.g. changelevel#22) (level number is a number from 0 to 31)
+-- Format: ref#<grace>,<tolerance>,<increment>[,<ref_0>,<ref_1>,...] (GESP check, the previous reference is kept if not sent)
+-- Format: savestate_<frame number>#<id> (saves the state of the processed frame as <id>)
+-- Format: loadstate#<id> (continues the episode from savestate <id>, sends ready as changelevel does)
+-- Format: dropstate#<id> (frees savestate <id>)
 -- Format: exit
 function parse_commands(line)
     -- Splitting line
@@ -666,6 +799,11 @@ function parse_commands(line)
         commands["start"] = false;
         commands["select"] = false;
         joypad.set(1, commands);
+        repeat_left = (tonumber(parts[7]) or 1) - 1;
+        if repeat_left > 0 then
+            is_chunk = 1;
+            chunk_trace = {};
+        end;
 
     -- Noop at beginning of level (to simulate seed)
     elseif ("noop" == command) and (tonumber(frame_number) == last_processed_frame) then
@@ -701,7 +839,46 @@ function parse_commands(line)
         is_finished = 0;
         changing_level = 0;
         reset_vars();
-        emu.softreset();
+        if (1 == savestates) and (nil ~= level_states[target]) then
+            -- Skipping the title screen and intro, the level is ready right away
+            savestate.load(level_states[target]);
+            reset_frame = emu.framecount();
+            is_started = 1;
+            send_ready();
+        else
+            emu.softreset();
+            reset_frame = emu.framecount();
+        end;
+
+    -- Savestates of processed frames (to continue an episode from them later)
+    elseif ("savestate" == command) and (tonumber(frame_number) == last_processed_frame) then
+        saved_states[data] = savestate.create();
+        savestate.save(saved_states[data]);
+
+    elseif ("loadstate" == command) and (nil ~= saved_states[data]) then
+        is_finished = 0;
+        changing_level = 0;
+        reset_vars();
+        savestate.load(saved_states[data]);
+        reset_frame = emu.framecount();
+        is_started = 1;
+        send_ready();
+
+    elseif "dropstate" == command then
+        saved_states[data] = nil;
+
+    -- Reference of the GESP check
+    elseif "ref" == command then
+        parts = split(data, ",");
+        gesp_grace = tonumber(parts[1]);
+        gesp_tolerance = tonumber(parts[2]);
+        gesp_increment = tonumber(parts[3]);
+        if #parts > 3 then
+            gesp_ref = {};
+            for i=4,#parts do
+                gesp_ref[i - 4] = tonumber(parts[i]);
+            end;
+        end;
 
     -- Exiting
     elseif "exit" == command then
@@ -825,7 +1002,7 @@ function main_loop()
     end;
 
     -- Checking if game has started, if not, pressing "start" to start it
-    if (0 == is_started) and (framecount == start_delay) then
+    if (0 == is_started) and (framecount - reset_frame == start_delay) then
         commands["start"] = true;
         joypad.set(1, commands);
         emu.frameadvance();
@@ -844,16 +1021,26 @@ function main_loop()
 
     -- Processed frame, getting commands (sync mode), sending back screen
     elseif framecount % skip_frames == 0 then
-        read_commands();
+        if repeat_left > 0 then
+            -- Next processed frame of the chunk, same commands
+            repeat_left = repeat_left - 1;
+            joypad.set(1, commands);
+            commands_rcvd = 1;
+        else
+            read_commands();
+        end;
         if commands_rcvd == 1 then
             commands_rcvd = 0
             emu.frameadvance();
             update_positions();
-            show_curr_distance();
-            get_tiles();
-            get_data();
-            get_screen();
-            ask_for_commands();
+            check_gesp();
+            add_to_chunk_trace();
+            if (repeat_left > 0) and (0 == is_finished) then
+                -- Middle of a chunk, nothing is sent
+                show_curr_distance();
+            else
+                send_frame();
+            end;
         end;
 
     -- Skipped frame, using same command as last frame, not returning screen
@@ -867,7 +1054,11 @@ function main_loop()
 
     -- Exiting if game is finished
     if (1 == is_finished) then
-        if 0 == meta then
+        if (0 == meta) and (1 == persistent) then
+            -- Persistent single mission - Waiting for changelevel to play the level again
+            read_commands();
+
+        elseif 0 == meta then
             -- Single Mission
             for i=1,20,1 do         -- Gives python a couple of ms to process it
                 emu.frameadvance();
@@ -1,3 +1,5 @@
+import atexit
+import errno
 import logging
 import os
 import multiprocessing
@@ -5,7 +7,7 @@ import signal
 import subprocess
 import tempfile
 from distutils import spawn
-from threading import Thread, Lock
+from threading import Thread, Lock, Condition
 from time import sleep
 
 import numpy as np
@@ -21,9 +23,171 @@ if FCEUX_PATH is None:
 
 logger = logging.getLogger(__name__)
 
+# fceux processes launched by this process (each one in its own session), killed (with their process group) and
+# reaped at exit. If this process dies without running atexit (e.g. SIGKILL on a timeout), the lua script exits
+# when its command pipe is closed.
+FCEUX_PROCESSES = set()
+
+def _kill_fceux_process(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    try:
+        process.wait(timeout=1)
+    except subprocess.TimeoutExpired:
+        pass
+    FCEUX_PROCESSES.discard(process)
+
+@atexit.register
+def _kill_all_fceux_processes():
+    for process in list(FCEUX_PROCESSES):
+        _kill_fceux_process(process)
+
 # Constants
 NUM_ACTIONS = 6
 
+# NES palette (as sent by the lua script: 2 hex digits, 00 to 7F) to RGB
+NES_PALETTE_RGB = {
+    '00': (116, 116, 116),
+    '01': (36, 24, 140),
+    '02': (0, 0, 168),
+    '03': (68, 0, 156),
+    '04': (140, 0, 116),
+    '05': (168, 0, 16),
+    '06': (164, 0, 0),
+    '07': (124, 8, 0),
+    '08': (64, 44, 0),
+    '09': (0, 68, 0),
+    '0A': (0, 80, 0),
+    '0B': (0, 60, 20),
+    '0C': (24, 60, 92),
+    '0D': (0, 0, 0),
+    '0E': (0, 0, 0),
+    '0F': (0, 0, 0),
+    '10': (188, 188, 188),
+    '11': (0, 112, 236),
+    '12': (32, 56, 236),
+    '13': (128, 0, 240),
+    '14': (188, 0, 188),
+    '15': (228, 0, 88),
+    '16': (216, 40, 0),
+    '17': (200, 76, 12),
+    '18': (136, 112, 0),
+    '19': (0, 148, 0),
+    '1A': (0, 168, 0),
+    '1B': (0, 144, 56),
+    '1C': (0, 128, 136),
+    '1D': (0, 0, 0),
+    '1E': (0, 0, 0),
+    '1F': (0, 0, 0),
+    '20': (252, 252, 252),
+    '21': (60, 188, 252),
+    '22': (92, 148, 252),
+    '23': (204, 136, 252),
+    '24': (244, 120, 252),
+    '25': (252, 116, 180),
+    '26': (252, 116, 96),
+    '27': (252, 152, 56),
+    '28': (240, 188, 60),
+    '29': (128, 208, 16),
+    '2A': (76, 220, 72),
+    '2B': (88, 248, 152),
+    '2C': (0, 232, 216),
+    '2D': (120, 120, 120),
+    '2E': (0, 0, 0),
+    '2F': (0, 0, 0),
+    '30': (252, 252, 252),
+    '31': (168, 228, 252),
+    '32': (196, 212, 252),
+    '33': (212, 200, 252),
+    '34': (252, 196, 252),
+    '35': (252, 196, 216),
+    '36': (252, 188, 176),
+    '37': (252, 216, 168),
+    '38': (252, 228, 160),
+    '39': (224, 252, 160),
+    '3A': (168, 240, 188),
+    '3B': (176, 252, 204),
+    '3C': (156, 252, 240),
+    '3D': (196, 196, 196),
+    '3E': (0, 0, 0),
+    '3F': (0, 0, 0),
+    '40': (87, 87, 87),
+    '41': (27, 18, 105),
+    '42': (0, 0, 126),
+    '43': (51, 0, 117),
+    '44': (105, 0, 87),
+    '45': (126, 0, 12),
+    '46': (123, 0, 0),
+    '47': (93, 6, 0),
+    '48': (48, 33, 0),
+    '49': (0, 51, 0),
+    '4A': (0, 60, 0),
+    '4B': (0, 45, 15),
+    '4C': (18, 45, 69),
+    '4D': (0, 0, 0),
+    '4E': (0, 0, 0),
+    '4F': (0, 0, 0),
+    '50': (141, 141, 141),
+    '51': (0, 84, 177),
+    '52': (24, 42, 177),
+    '53': (96, 0, 180),
+    '54': (141, 0, 141),
+    '55': (171, 0, 66),
+    '56': (162, 30, 0),
+    '57': (150, 57, 9),
+    '58': (102, 84, 0),
+    '59': (0, 111, 0),
+    '5A': (0, 126, 0),
+    '5B': (0, 108, 42),
+    '5C': (0, 96, 102),
+    '5D': (0, 0, 0),
+    '5E': (0, 0, 0),
+    '5F': (0, 0, 0),
+    '60': (189, 189, 189),
+    '61': (45, 141, 189),
+    '62': (69, 111, 189),
+    '63': (153, 102, 189),
+    '64': (183, 90, 189),
+    '65': (189, 87, 135),
+    '66': (189, 87, 72),
+    '67': (189, 114, 42),
+    '68': (180, 141, 45),
+    '69': (96, 156, 12),
+    '6A': (57, 165, 54),
+    '6B': (66, 186, 114),
+    '6C': (0, 174, 162),
+    '6D': (90, 90, 90),
+    '6E': (0, 0, 0),
+    '6F': (0, 0, 0),
+    '70': (189, 189, 189),
+    '71': (126, 171, 189),
+    '72': (147, 159, 189),
+    '73': (159, 150, 189),
+    '74': (189, 147, 189),
+    '75': (189, 147, 162),
+    '76': (189, 141, 132),
+    '77': (189, 162, 126),
+    '78': (189, 171, 120),
+    '79': (168, 189, 120),
+    '7A': (126, 180, 141),
+    '7B': (132, 189, 153),
+    '7C': (117, 189, 180),
+    '7D': (147, 147, 147),
+    '7E': (0, 0, 0),
+    '7F': (0, 0, 0),
+}
+# Lookup table indexed by palette number, unknown numbers are black
+NES_PALETTE = np.zeros(shape=(256, 3), dtype=np.uint8)
+for palette, rgb in NES_PALETTE_RGB.items():
+    NES_PALETTE[int(palette, 16)] = rgb
+# Hex digit (ascii code) to value, 255 for non hex characters
+HEX_VALUES = np.full(256, 255, dtype=np.uint8)
+for c in '0123456789abcdef':
+    HEX_VALUES[ord(c)] = HEX_VALUES[ord(c.upper())] = int(c, 16)
+
+
 # Singleton pattern
 class NesLock:
     class __NesLock:
@@ -54,6 +218,9 @@ class NesEnv(gym.Env, utils.EzPickle):
         self.fceux_pid = None
         self.no_render = True
         self.viewer = None
+        self.persistent = False     # Keeps fceux running between episodes (reset() restarts the level in the emulator)
+        self.ready_timeout = 20     # Seconds without ready before fceux is considered hung and relaunched
+        self.frame_timeout = 5      # Seconds to process the frames of a step before fceux is considered hung
 
         # Pipes
         self.pipe_name = ''
@@ -62,14 +229,17 @@ class NesEnv(gym.Env, utils.EzPickle):
         self.path_pipe_out = ''     # Output pipe (maps to fceux in-pipe and to 'out' file)
         self.pipe_out = None
         self.lock_out = Lock()
+        self.pipe_event = Condition()   # Notified each time the listening thread has processed a message
         self.disable_in_pipe = False
         self.disable_out_pipe = False
         self.launch_vars['pipe_name'] = ''
         self.launch_vars['pipe_prefix'] = self.path_pipe_prefix
+        self.launch_vars['persistent'] = '0'
 
         # Other vars
         self.is_initialized = 0     # Used to indicate fceux has been launched and is running
         self.is_exiting = 0         # Used to stop the listening thread
+        self.is_restarting = False  # Messages of the previous episode are ignored until the level is ready again
         self.last_frame = 0         # Last processed frame
         self.reward = 0             # Reward for last action
         self.episode_reward = 0     # Total rewards for episode
@@ -79,6 +249,7 @@ class NesEnv(gym.Env, utils.EzPickle):
         self.level = 0
         self._reset_info_vars()
         self.first_step = False
+        self.noop = None            # Noop frames at the start of the next episode, drawn from the seed if None
         self.lock = (NesLock()).get_lock()
 
         self.temp_lua_path = ""
@@ -104,7 +275,7 @@ class NesEnv(gym.Env, utils.EzPickle):
         # Launching a thread that will listen to incoming pipe
         # Thread exits if self.is_exiting = 1 or pipe_in is closed
         if not self.disable_in_pipe:
-            thread_incoming = Thread(target=self._listen_to_incoming_pipe, kwargs={'pipe_name': self.pipe_name})
+            thread_incoming = Thread(target=self._listen_to_incoming_pipe, kwargs={'pipe_name': self.pipe_name}, daemon=True)
             thread_incoming.start()
 
         # Cannot open output pipe now, otherwise it will block until
@@ -167,6 +338,8 @@ class NesEnv(gym.Env, utils.EzPickle):
                         self._process_pipe_message(buffer[:-1])
                     except:
                         pass
+                    with self.pipe_event:
+                        self.pipe_event.notify_all()
                     if 'exit' == buffer[-5:-1]:
                         break
                     buffer = ''
@@ -214,23 +387,22 @@ class NesEnv(gym.Env, utils.EzPickle):
 
         # Loading fceux
         args = [FCEUX_PATH]
-        args.extend(self.cmd_args[:])
+        for arg in self.cmd_args:
+            args.extend(arg.split())
         args.extend(['--loadlua', self.temp_lua_path])
         args.append(self.rom_path)
-        args.extend(['>/dev/null', '2>/dev/null', '&'])
-        self.subprocess = subprocess.Popen("/bin/bash", shell=False, universal_newlines=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)                             
-        stdout, stderr = self.subprocess.communicate(' '.join(args) + "\necho $!")
-        self.fceux_pid = int(stdout)
-
+        try:
+            self.subprocess = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        except OSError:
+            self.subprocess = None
 
-        if 0 == self.subprocess.returncode:
+        if self.subprocess is not None:
+            self.fceux_pid = self.subprocess.pid
+            FCEUX_PROCESSES.add(self.subprocess)
             self.is_initialized = 1
             if not self.disable_out_pipe:
                 with self.lock_out:
-                    try:
-                        self.pipe_out = open(self.path_pipe_out, 'w', 1)
-                    except IOError:
-                        self.pipe_out = None
+                    self.pipe_out = self._open_pipe_out()
             # Removing lua file
             sleep(1)  # Sleeping to make sure fceux has time to load file before removing
             if os.path.isfile(self.temp_lua_path):
@@ -242,6 +414,21 @@ class NesEnv(gym.Env, utils.EzPickle):
             self.is_initialized = 0
             raise gym.error.Error('Unable to start fceux. Command: %s' % (' '.join(args)))
 
+    def _open_pipe_out(self):
+        # Opening the fifo blocks until fceux opens it for reading, which never happens if fceux exits before
+        # (polled without blocking instead, while fceux is alive and for at most ready_timeout seconds)
+        for _ in range(int(self.ready_timeout * 100)):
+            try:
+                fd = os.open(self.path_pipe_out, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                if e.errno != errno.ENXIO or self.subprocess.poll() is not None:
+                    return None
+                sleep(0.01)
+                continue
+            os.set_blocking(fd, True)
+            return os.fdopen(fd, 'w', 1)
+        return None
+
     def _reset_info_vars(self):
         # Overridable - To reset the information variables
         self.info = {}
@@ -270,7 +457,14 @@ class NesEnv(gym.Env, utils.EzPickle):
         # Overridable - Returns the other variables
         return self.info
 
-    def step(self, action):
+    def _wait_for_pipe(self, is_done, timeout):
+        # Blocks until is_done() (checked each time a message is processed) or fceux is closed, False on timeout
+        with self.pipe_event:
+            return self.pipe_event.wait_for(lambda: is_done() or 0 == self.is_initialized, timeout)
+
+    def step(self, action, repeat=1):
+        # With repeat > 1, the action is used for the next <repeat> processed frames and the results of the last one
+        # are returned (the game can send a trace of the frames in between, see SuperMarioBrosEnv)
         if 0 == self.is_initialized:
             return self._get_state(), 0, self._get_is_finished(), {}
 
@@ -281,29 +475,27 @@ class NesEnv(gym.Env, utils.EzPickle):
             for i in range(len(old_action)):
                 action[i] = old_action[i]
 
-        # Blocking until game sends ready
-        loop_counter = 0
+        # Blocking until game sends ready. fceux is relaunched as soon as it exits, or if it is hung (no ready
+        # in ready_timeout seconds). info['ignore'] is set when the episode was interrupted and should be played again.
+        wait_counter = 0
         restart_counter = 0
         if not self.disable_in_pipe:
-            while 0 == self.last_frame:
-                loop_counter += 1
-                sleep(0.001)
-                if 0 == self.is_initialized:
-                    break
-                if loop_counter >= 20000:
+            while not self._wait_for_pipe(lambda: 0 != self.last_frame, 0.5):
+                wait_counter += 1
+                if not self._fceux_is_alive() or wait_counter * 0.5 >= self.ready_timeout:
                     # Game not properly launched, relaunching
                     restart_counter += 1
-                    loop_counter = 0
+                    wait_counter = 0
                     if restart_counter > 5:
                         self.close()
-                        return self._get_state(), 0, True, {}
+                        return self._get_state(), 0, True, {'ignore': True}
                     else:
+                        self._terminate_fceux()
                         self.reset()
-                        sleep(5)
 
-                elif loop_counter % 2500 == 0 and loop_counter > 4900:
+                elif wait_counter == 5:
                     # Incoming pipe not opened properly, reopening
-                    thread_incoming = Thread(target=self._listen_to_incoming_pipe, kwargs={'pipe_name': self.pipe_name})
+                    thread_incoming = Thread(target=self._listen_to_incoming_pipe, kwargs={'pipe_name': self.pipe_name}, daemon=True)
                     thread_incoming.start()
 
         start_frame = self.last_frame
@@ -311,27 +503,31 @@ class NesEnv(gym.Env, utils.EzPickle):
         # Sending no-ops if in first step
         if self.first_step:
             self.first_step = False
-            self.curr_seed = seeding.hash_seed(self.curr_seed) % 256
-            self._write_to_pipe('noop_%d#%d' % (start_frame, self.curr_seed))
+            if self.noop is None:
+                self.curr_seed = seeding.hash_seed(self.curr_seed) % 256
+                self.noop = self.curr_seed
+            self._write_to_pipe('noop_%d#%d' % (start_frame, self.noop))
+            self.noop = None
 
         # Sending commands and resetting reward to 0
         self.reward = 0
-        self._write_to_pipe('commands_%d#%s' % (start_frame, ','.join([str(i) for i in action])))
+        commands = ','.join([str(i) for i in action])
+        if repeat > 1:
+            commands += ',%d' % repeat
+        self._write_to_pipe('commands_%d#%s' % (start_frame, commands))
 
         # Waiting for frame to be processed (self.last_frame will be increased when done)
-        loop_counter = 0
         if not self.disable_in_pipe:
-            while self.last_frame <= start_frame and not self.is_finished:
-                loop_counter += 1
-                sleep(0.001)
-                if 0 == self.is_initialized:
-                    break
-                if loop_counter >= 20000:
-                    # Game stuck, returning
-                    # Likely caused by fceux incoming pipe not working
-                    logger.warn('Closing episode (appears to be stuck). See documentation for how to handle this issue.')
-                    self._terminate_fceux()
-                    return self._get_state(), 0, True, {'ignore': True}
+            is_processed = lambda: self.last_frame > start_frame or self.is_finished
+            wait_counter = 0
+            while not self._wait_for_pipe(is_processed, 0.5) and self._fceux_is_alive() and wait_counter * 0.5 < self.frame_timeout:
+                wait_counter += 1
+            if not is_processed():
+                # Game stuck or dead, returning
+                # Likely caused by fceux incoming pipe not working
+                logger.warn('Closing episode (appears to be stuck). See documentation for how to handle this issue.')
+                self._terminate_fceux()
+                return self._get_state(), 0, True, {'ignore': True}
 
         # Getting results
         reward = self._get_reward()
@@ -340,7 +536,42 @@ class NesEnv(gym.Env, utils.EzPickle):
         info = self._get_info()
         return state, reward, is_finished, info
 
+    def _fceux_is_alive(self):
+        if 0 == self.is_initialized or self.subprocess is None:
+            return False
+        return self.subprocess.poll() is None
+
+    def _restart_episode(self, message=None):
+        # Restarts the level in the running fceux (persistent mode) instead of relaunching it, or continues an episode
+        # from a savestate with a loadstate message (no noop is sent then)
+        self.is_restarting = True
+        self.last_frame = 0
+        self.reward = 0
+        self.episode_reward = 0
+        self.is_finished = False
+        self.first_step = message is None
+        self._reset_info_vars()
+        self._write_to_pipe(message or 'changelevel#%d' % self.level)
+        self._start_episode()
+        self.screen = np.zeros(shape=(self.screen_height, self.screen_width, 3), dtype=np.uint8)
+        return self._get_state()
+
+    def save_state(self, state_id):
+        # Saves the last processed frame in fceux as state_id, to continue from it later with load_state (persistent mode)
+        self._write_to_pipe('savestate_%d#%d' % (self.last_frame, state_id))
+
+    def load_state(self, state_id):
+        # Continues the episode from the savestate state_id in the running fceux, returns as reset()
+        return self._restart_episode('loadstate#%d' % state_id)
+
+    def drop_state(self, state_id):
+        # Frees the savestate state_id in fceux
+        self._write_to_pipe('dropstate#%d' % state_id)
+
     def reset(self):
+        if self.persistent and self._fceux_is_alive():
+            return self._restart_episode()
+
         self._terminate_fceux()
 
         if 1 == self.is_initialized:
@@ -350,6 +581,7 @@ class NesEnv(gym.Env, utils.EzPickle):
         self.episode_reward = 0
         self.is_finished = False
         self.first_step = True
+        self.is_restarting = False
         self._reset_info_vars()
         with self.lock:
             self._launch_fceux()
@@ -392,15 +624,12 @@ class NesEnv(gym.Env, utils.EzPickle):
         self.screen = np.zeros(shape=(self.screen_height, self.screen_width, 3), dtype=np.uint8)
         self._reset_info_vars()
         self.is_initialized = 0
+        with self.pipe_event:
+            self.pipe_event.notify_all()
 
     def _terminate_fceux(self):
         if self.subprocess is not None:
-            try:
-                os.kill(self.fceux_pid, signal.SIGKILL)
-            except OSError as e:
-                cmd = "kill -9 $(ps -ef | grep 'fceux' | grep " + self.temp_lua_path + " | awk '{print $2}')"
-                os.system(cmd)
-                pass
+            _kill_fceux_process(self.subprocess)
             self.subprocess = None
 
     def _seed(self, seed=None):
@@ -408,139 +637,9 @@ class NesEnv(gym.Env, utils.EzPickle):
         return [self.curr_seed]
 
     def _get_rgb_from_palette(self, palette):
-        rgb = {
-            '00': (116, 116, 116),
-            '01': (36, 24, 140),
-            '02': (0, 0, 168),
-            '03': (68, 0, 156),
-            '04': (140, 0, 116),
-            '05': (168, 0, 16),
-            '06': (164, 0, 0),
-            '07': (124, 8, 0),
-            '08': (64, 44, 0),
-            '09': (0, 68, 0),
-            '0A': (0, 80, 0),
-            '0B': (0, 60, 20),
-            '0C': (24, 60, 92),
-            '0D': (0, 0, 0),
-            '0E': (0, 0, 0),
-            '0F': (0, 0, 0),
-            '10': (188, 188, 188),
-            '11': (0, 112, 236),
-            '12': (32, 56, 236),
-            '13': (128, 0, 240),
-            '14': (188, 0, 188),
-            '15': (228, 0, 88),
-            '16': (216, 40, 0),
-            '17': (200, 76, 12),
-            '18': (136, 112, 0),
-            '19': (0, 148, 0),
-            '1A': (0, 168, 0),
-            '1B': (0, 144, 56),
-            '1C': (0, 128, 136),
-            '1D': (0, 0, 0),
-            '1E': (0, 0, 0),
-            '1F': (0, 0, 0),
-            '20': (252, 252, 252),
-            '21': (60, 188, 252),
-            '22': (92, 148, 252),
-            '23': (204, 136, 252),
-            '24': (244, 120, 252),
-            '25': (252, 116, 180),
-            '26': (252, 116, 96),
-            '27': (252, 152, 56),
-            '28': (240, 188, 60),
-            '29': (128, 208, 16),
-            '2A': (76, 220, 72),
-            '2B': (88, 248, 152),
-            '2C': (0, 232, 216),
-            '2D': (120, 120, 120),
-            '2E': (0, 0, 0),
-            '2F': (0, 0, 0),
-            '30': (252, 252, 252),
-            '31': (168, 228, 252),
-            '32': (196, 212, 252),
-            '33': (212, 200, 252),
-            '34': (252, 196, 252),
-            '35': (252, 196, 216),
-            '36': (252, 188, 176),
-            '37': (252, 216, 168),
-            '38': (252, 228, 160),
-            '39': (224, 252, 160),
-            '3A': (168, 240, 188),
-            '3B': (176, 252, 204),
-            '3C': (156, 252, 240),
-            '3D': (196, 196, 196),
-            '3E': (0, 0, 0),
-            '3F': (0, 0, 0),
-            '40': (87, 87, 87),
-            '41': (27, 18, 105),
-            '42': (0, 0, 126),
-            '43': (51, 0, 117),
-            '44': (105, 0, 87),
-            '45': (126, 0, 12),
-            '46': (123, 0, 0),
-            '47': (93, 6, 0),
-            '48': (48, 33, 0),
-            '49': (0, 51, 0),
-            '4A': (0, 60, 0),
-            '4B': (0, 45, 15),
-            '4C': (18, 45, 69),
-            '4D': (0, 0, 0),
-            '4E': (0, 0, 0),
-            '4F': (0, 0, 0),
-            '50': (141, 141, 141),
-            '51': (0, 84, 177),
-            '52': (24, 42, 177),
-            '53': (96, 0, 180),
-            '54': (141, 0, 141),
-            '55': (171, 0, 66),
-            '56': (162, 30, 0),
-            '57': (150, 57, 9),
-            '58': (102, 84, 0),
-            '59': (0, 111, 0),
-            '5A': (0, 126, 0),
-            '5B': (0, 108, 42),
-            '5C': (0, 96, 102),
-            '5D': (0, 0, 0),
-            '5E': (0, 0, 0),
-            '5F': (0, 0, 0),
-            '60': (189, 189, 189),
-            '61': (45, 141, 189),
-            '62': (69, 111, 189),
-            '63': (153, 102, 189),
-            '64': (183, 90, 189),
-            '65': (189, 87, 135),
-            '66': (189, 87, 72),
-            '67': (189, 114, 42),
-            '68': (180, 141, 45),
-            '69': (96, 156, 12),
-            '6A': (57, 165, 54),
-            '6B': (66, 186, 114),
-            '6C': (0, 174, 162),
-            '6D': (90, 90, 90),
-            '6E': (0, 0, 0),
-            '6F': (0, 0, 0),
-            '70': (189, 189, 189),
-            '71': (126, 171, 189),
-            '72': (147, 159, 189),
-            '73': (159, 150, 189),
-            '74': (189, 147, 189),
-            '75': (189, 147, 162),
-            '76': (189, 141, 132),
-            '77': (189, 162, 126),
-            '78': (189, 171, 120),
-            '79': (168, 189, 120),
-            '7A': (126, 180, 141),
-            '7B': (132, 189, 153),
-            '7C': (117, 189, 180),
-            '7D': (147, 147, 147),
-            '7E': (0, 0, 0),
-            '7F': (0, 0, 0),
-        }
-        if palette.upper() in rgb:
-            return rgb[palette.upper()]
-        else:
+        try:
+            return tuple(NES_PALETTE[int(palette, 16)])
+        except (ValueError, IndexError):
             return 0, 0, 0
 
 
@@ -661,12 +760,12 @@ class MetaNesEnv(NesEnv):
         self.screen = np.zeros(shape=(self.screen_height, self.screen_width, 3), dtype=np.uint8)
         return self._get_state()
 
-    def step(self, action):
+    def step(self, action, repeat=1):
         # Changing level
         if self.find_new_level:
             self.change_level()
 
-        obs, step_reward, is_finished, info = NesEnv.step(self, action)
+        obs, step_reward, is_finished, info = NesEnv.step(self, action, repeat)
         reward, self.total_reward = self._calculate_reward(self._get_episode_reward(), self.total_reward)
         # First step() after new episode returns the entire total reward
         # because stats_recorder resets the episode score to 0 after reset() is called
@@ -4,7 +4,7 @@ import os
 import numpy as np
 
 from gym import spaces
-from .nes_env import NesEnv, MetaNesEnv
+from .nes_env import NesEnv, MetaNesEnv, NES_PALETTE, HEX_VALUES
 
 logger = logging.getLogger(__name__)
 
@@ -39,7 +39,7 @@ def is_int16(str):
 # Classes
 # --------------
 class SuperMarioBrosEnv(NesEnv):
-    def __init__(self, draw_tiles=False, level=0):
+    def __init__(self, draw_tiles=False, level=0, persistent=False, savestates=False, compact=False, channels=None):
         NesEnv.__init__(self)
         package_directory = os.path.dirname(os.path.abspath(__file__))
         self.level = level
@@ -51,6 +51,17 @@ class SuperMarioBrosEnv(NesEnv):
         self.launch_vars['mode'] = 'algo'
         self.launch_vars['meta'] = '0'
         self.launch_vars['draw_tiles'] = str(self.draw_tiles)
+        self.persistent = persistent
+        self.launch_vars['persistent'] = '1' if persistent else '0'
+        # Only used when the level is restarted (persistent mode): the first controllable frame of each level is
+        # saved in fceux the first time it is reached, and loaded on the next resets
+        self.launch_vars['savestates'] = '1' if savestates else '0'
+        # Whole tile grids and fixed data records (grid_ and state_ messages) instead of diffs
+        self.launch_vars['compact'] = '1' if compact else '0'
+        # Observation channels sent by fceux, e.g. ('tiles', 'distance'): 'screen', 'tiles' and the data fields of
+        # self.info ('distance', 'life', 'score', 'coins', 'time', 'player_status'). Everything is sent if None.
+        self.launch_vars['channels'] = ','.join(channels) if channels else ''
+        self.gesp_ref_sent = None       # Last reference sent to fceux with send_gesp_reference()
         if os.path.isfile(SUPER_MARIO_ROM_PATH):
             self.rom_path = SUPER_MARIO_ROM_PATH
 
@@ -61,6 +72,7 @@ class SuperMarioBrosEnv(NesEnv):
             self.screen_height = 13
             self.screen_width = 16
             self.tiles = np.zeros(shape=(self.tile_height, self.tile_width), dtype=np.uint8)
+            self.tile_colors = NES_PALETTE[[0x0D, 0x30, 0x27, 0x05]]
             self.observation_space = spaces.Box(low=0, high=3, shape=(self.tile_height, self.tile_width))
 
     # --------------
@@ -94,6 +106,36 @@ class SuperMarioBrosEnv(NesEnv):
             area_number += 1
         return '%d%d%d' % (world_number, level_number, area_number)
 
+    def send_gesp_reference(self, t_grace, ref, tolerance=0.0, increment=None):
+        # Makes fceux early stop the episode with the GESP rule (is_finished and info['gesp_stopped'] are set)
+        # Must be called after reset(), once per episode. Disabled for this episode if t_grace is None
+        # Format: ref#<t_grace>,<tolerance>,<increment>[,<ref_0>,<ref_1>,...] (ref only sent if it has changed)
+        message = 'ref#%d,%r,%d' % (-1 if t_grace is None else t_grace, float(tolerance), 0 if increment is None else increment)
+        if t_grace is not None and (self.gesp_ref_sent is None or not np.array_equal(self.gesp_ref_sent, ref)):
+            self.gesp_ref_sent = np.array(ref, dtype=np.float64)
+            message += ',' + ','.join(map(repr, self.gesp_ref_sent.tolist()))
+        self._write_to_pipe(message)
+
+    def reset(self):
+        if not (self.persistent and self._fceux_is_alive()):
+            # New fceux, without reference
+            self.gesp_ref_sent = None
+        # The first observation of the episode is an empty grid, not the last one of the previous episode
+        if self.tiles is not None:
+            self.tiles[:] = 0
+        return super().reset()
+
+    def step(self, action, repeat=1):
+        # With repeat > 1, info['distance_trace'] has the distance of each processed frame (fewer if the level finished)
+        self.info.pop('distance_trace', None)
+        return super().step(action, repeat)
+
+    def _process_trace_message(self, frame_number, data):
+        # Format: trace_<frame>#<distance_1>,<distance_2>,...
+        if frame_number <= self.last_frame or self.info is None:
+            return
+        self.info['distance_trace'] = [int(distance) for distance in data.split(',') if distance != '']
+
     def _process_data_message(self, frame_number, data):
         # Format: data_<frame>#name_1:value_1|name_2:value_2|...
         if frame_number <= self.last_frame or self.info is None:
@@ -114,16 +156,34 @@ class SuperMarioBrosEnv(NesEnv):
             else:
                 self.info[name] = value
 
+    def _process_state_message(self, frame_number, data):
+        # Format: state_<frame>#distance,life,score,coins,time,player_status,is_finished,gesp_stopped
+        if frame_number <= self.last_frame or self.info is None:
+            return
+        distance, life, score, coins, time, player_status, is_finished, gesp_stopped = map(int, data.split('|', 1)[0].split(','))
+        self.reward = distance - self.info['distance']
+        self.episode_reward = distance
+        self.info['distance'] = distance
+        self.info['life'] = life
+        self.info['score'] = score
+        self.info['coins'] = coins
+        self.info['time'] = time
+        self.info['player_status'] = player_status
+        self.info['gesp_stopped'] = gesp_stopped
+        self.is_finished = bool(is_finished)
+
     def _process_screen_message(self, frame_number, data):
         # Format: screen_<frame>#<x (2 hex)><y (2 hex)><palette (2 hex)>|<x><y><p>|...
         if frame_number <= self.last_frame or self.screen is None:
             return
-        parts = data.split('|')
-        for part in parts:
-            if 6 == len(part) and is_int16(part[0:2]) and is_int16(part[2:4]):
-                x = int(part[0:2], 16)
-                y = int(part[2:4], 16)
-                self.screen[y][x] = self._get_rgb_from_palette(part[4:6])
+        # Decoding all the pixels at once: 6 hex digits per pixel, invalid palettes are black
+        pixels = ''.join(part for part in data.split('|') if 6 == len(part)).encode('ascii')
+        digits = HEX_VALUES[np.frombuffer(pixels, dtype=np.uint8)].reshape(-1, 6).astype(np.int64)
+        x = digits[:, 0] * 16 + digits[:, 1]
+        y = digits[:, 2] * 16 + digits[:, 3]
+        palette = np.where((digits[:, 4:6] < 16).all(axis=1), digits[:, 4] * 16 + digits[:, 5], 255)
+        is_valid = (digits[:, 0:4] < 16).all(axis=1) & (x < self.screen.shape[1]) & (y < self.screen.shape[0])
+        self.screen[y[is_valid], x[is_valid]] = NES_PALETTE[palette[is_valid]]
 
     def _process_tiles_message(self, frame_number, data):
         # Format: tiles_<frame>#<x (1 hex)><y (1 hex)><value (1 hex)>|<x><y><v>|...
@@ -136,10 +196,15 @@ class SuperMarioBrosEnv(NesEnv):
                 y = int(part[1:2], 16)
                 v = int(part[2:3], 16)
                 self.tiles[y][x] = v
-                if v == 0: self.screen[y][x] = self._get_rgb_from_palette('0D')
-                if v == 1: self.screen[y][x] = self._get_rgb_from_palette('30')
-                if v == 2: self.screen[y][x] = self._get_rgb_from_palette('27')
-                if v == 3: self.screen[y][x] = self._get_rgb_from_palette('05')
+                if v <= 3: self.screen[y][x] = self.tile_colors[v]
+
+    def _process_grid_message(self, frame_number, data):
+        # Format: grid_<frame>#<value (1 digit) of each tile, row by row>
+        if frame_number <= self.last_frame or self.tiles is None:
+            return
+        grid = np.frombuffer(data.encode('ascii'), dtype=np.uint8, count=self.tile_height * self.tile_width) - ord('0')
+        self.tiles[:] = grid.reshape(self.tile_height, self.tile_width)
+        self.screen[:self.tile_height, :self.tile_width] = self.tile_colors[self.tiles]
 
     def _process_ready_message(self, frame_number):
         # Format: ready_<frame>
@@ -201,9 +266,21 @@ class SuperMarioBrosEnv(NesEnv):
         if frame_number is None:
             return
 
+        # Level restarted in a persistent fceux - Ignoring the rest of the previous episode
+        if self.is_restarting and 'exit' != message_type:
+            if 'ready' != message_type:
+                return
+            self.is_restarting = False
+
         # Processing
         if 'data' == message_type:
             self._process_data_message(frame_number, data)
+        elif 'state' == message_type:
+            self._process_state_message(frame_number, data)
+        elif 'grid' == message_type:
+            self._process_grid_message(frame_number, data)
+        elif 'trace' == message_type:
+            self._process_trace_message(frame_number, data)
         elif 'screen' == message_type:
             self._process_screen_message(frame_number, data)
         elif 'tiles' == message_type:
@@ -242,7 +319,8 @@ class SuperMarioBrosEnv(NesEnv):
             'score': -1,
             'coins': -1,
             'time': -1,
-            'player_status': -1
+            'player_status': -1,
+            'gesp_stopped': 0
         }
 
 
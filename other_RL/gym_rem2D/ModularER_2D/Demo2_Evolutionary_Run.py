@@ -57,6 +57,9 @@ parser.add_argument('--method', required=True, metavar='method', type=str, help=
 parser.add_argument('--seed', required=True, metavar='seed', type=int, help='Grace time parameter', default=None, nargs='?')
 parser.add_argument('--gracetime', required=True, metavar='gracetime', type=int, help='Grace time parameter', default=None, nargs='?')
 parser.add_argument('--res_filepath', required=True, metavar='res_filepath', type=str, help='Result file path', default=None, nargs='?')
+parser.add_argument('--tolerance', required=False, metavar='tolerance', type=float, help='Tolerance margin of GESP.', default=0.0, nargs='?')
+parser.add_argument('--adaptive_tgrace', action='store_true', help='Retune the grace time during the run with audit episodes (only with bestasref).')
+parser.add_argument('--reference_mode', required=False, metavar='reference_mode', type=str, help='When a better episode becomes the GESP reference: asynchronous or generation-synchronous.', default="asynchronous", nargs='?')
 
 args = parser.parse_args()
 
@@ -68,6 +71,7 @@ res_filepath = args.res_filepath
 
 sys.path.append('scripts/utils')
 from src_tgrace_experiment import TgraceNokillLogger, TgraceDifferentValuesLogger
+from gesp import GESPStopper, AdaptiveGESPStopper
 global_vars["TgraceNokillLogger"] = TgraceNokillLogger(
 	res_filepath, 
 	global_vars["max_optimization_time_tgrace"],
@@ -82,8 +86,12 @@ global_vars["TgraceDifferentValuesLogger"] = TgraceDifferentValuesLogger(
 if method == "nokill_tgrace_exp" or method == "tgrace_different_values":
 	res_filepath="/dev/null"
 
-global_vars["REF_FITNESSES"] = np.array([-1e20] * global_vars["MAX_EPISODE_LENGTH"])
-global_vars["OBSERVED_FITNESSES"] = np.array([-1e20] * global_vars["MAX_EPISODE_LENGTH"])
+# Only bestasref stops early, the rest of the methods get a grace period longer than the episode.
+if args.adaptive_tgrace and method == "bestasref":
+	STOPPER = AdaptiveGESPStopper(global_vars["MAX_EPISODE_LENGTH"], GRACE, reference_mode=args.reference_mode, tolerance=args.tolerance, seed=seed)
+else:
+	STOPPER = GESPStopper(global_vars["MAX_EPISODE_LENGTH"], GRACE if method == "bestasref" else global_vars["MAX_EPISODE_LENGTH"], reference_mode=args.reference_mode, tolerance=args.tolerance)
+global_vars["REF_FITNESSES"] = STOPPER.ref
 
 print("----")
 print(args)
@@ -107,7 +115,6 @@ def callback_en_of_step(self, done, fitness, global_vars):
 	if global_vars["max_optimization_time"] < STOPWATCH.get_time():
 		exit(0)
 
-	import copy
 	i = self.current_steps
 	if i==0 and not global_vars["reseted_sw_after_first_step"]:
 		STOPWATCH.reset()
@@ -116,19 +123,13 @@ def callback_en_of_step(self, done, fitness, global_vars):
 		global_vars["reseted_sw_after_first_step"] == True
 
 	if method=="nokill_tgrace_exp" and i==0:
-		v = copy.deepcopy(global_vars["OBSERVED_FITNESSES"])
-		v = v[v != -1e20]
+		v = STOPPER.observed[STOPPER.observed != STOPPER.initial_value]
 		if len(v) > 10:
 			global_vars["TgraceNokillLogger"].log_values(v)
-			# with open("/home/paran/Dropbox/BCAM/07_estancia_1/code/results/data/tgrace_experiment/debuglog.txt", "a") as f:
-			# 	print(STOPWATCH.get_time(), v, file=f)
 
-	global_vars["OBSERVED_FITNESSES"][i] = fitness
 	# Halt computation cumulative reward is worse than ref
-	if method == "bestasref":
-		if i >= GRACE and global_vars["REF_FITNESSES"][i - GRACE] > fitness:
-			# print("Stop computation after", i," steps: ref , observed =  ", REF_FITNESSES[i - GRACE], fitness)
-			self.wod.position = 10000000.0 # increase wall of death substantially
+	if STOPPER.observe(i, fitness):
+		self.wod.position = 10000000.0 # increase wall of death substantially
 
 
 	# print(done, self.current_steps, self.total_steps)
@@ -144,11 +145,8 @@ def callback_en_of_step(self, done, fitness, global_vars):
 		# print(f"Used ",global_vars["STEPS_CURRENT"]," steps.")
 		global_vars["STEPS_CURRENT"] = 0
 		# Updating ref fitness.
-		if fitness > global_vars["REF_FITNESSES"][-1]:
+		if STOPPER.commit(fitness):
 			print("--Updating refs--")
-			print("Old refs:", global_vars["REF_FITNESSES"])
-			global_vars["REF_FITNESSES"][0:i] = global_vars["OBSERVED_FITNESSES"][0:i]
-			global_vars["REF_FITNESSES"][i:] = fitness
 			print("New refs:", global_vars["REF_FITNESSES"])
 			print("--")
 
@@ -164,6 +162,13 @@ def callback_end_of_gen(self, global_vars):
 
 	print(global_vars)
 
+	if STOPPER.end_generation():
+		print("--Updating refs at the end of the generation--")
+		print("New refs:", global_vars["REF_FITNESSES"])
+		print("--")
+	if isinstance(STOPPER, AdaptiveGESPStopper):
+		print("t_grace =", STOPPER.t_grace, "after", STOPPER.n_audits, "audit episodes and", STOPPER.n_audit_misses, "misses.")
+
 	if "tgrace" not in res_filepath:
 		best_fitness_test = self.ev_best(global_vars)
 		runtimes = "("+";".join(map(str, global_vars["RUNTIMES"]))+")"
@@ -20,11 +20,10 @@ sys.path.append(os.path.abspath('scripts/utils'))
 sys.path.append(os.path.abspath('scripts'))
 from progress_tracker import experimentProgressTracker
 import src_tgrace_experiment
+from gesp import GESPStopper, AdaptiveGESPStopper, TimeGESPStopper, SharedGESPReference, REFERENCE_MODES
 
 
 
-TOTAL_COMPUTED_STEPS = 0 # number of episodes (1 episode is equal to a complete begining -> [environment-> action -> reward] -> end cycle)
-RUNTIMES = []
 START_REF_TIME = None
 POPSIZE = 100  # CMA-ES Population size.
 
@@ -39,6 +38,11 @@ parser.add_argument('--gens', required=True, metavar='gens', type=int, help='NUm
 parser.add_argument('--max_episode_length', required=True, metavar='max_episode_length', type=int, help='Number of max frames per experiment', default=None, nargs='?')
 parser.add_argument('--res_filepath', required=True, metavar='res_filepath', type=str, help='Result file path', default=None, nargs='?')
 parser.add_argument('--max_optimization_time', required=False, metavar='max_optimization_time', type = float, help="total optimization budget in seconds", default=None, nargs='?')
+parser.add_argument('--reference_mode', required=False, metavar='reference_mode', type=str, help='When a better episode becomes the GESP reference: asynchronous or generation-synchronous.', default="asynchronous", nargs='?')
+parser.add_argument('--tolerance', required=False, metavar='tolerance', type=float, help='Tolerance margin of GESP.', default=0.0, nargs='?')
+parser.add_argument('--gracetime_seconds', required=False, metavar='gracetime_seconds', type=float, help='Grace time in wall-clock seconds. If given, GESP compares the curves by elapsed time instead of by step (only with bestasref).', default=None, nargs='?')
+parser.add_argument('--adaptive_tgrace', action='store_true', help='Retune the grace time during the run with audit episodes (only with bestasref).')
+parser.add_argument('--n_workers', required=False, metavar='n_workers', type=int, help='Number of processes that evaluate the population. With more than 1, garage MultiprocessingSampler is used.', default=1, nargs='?')
 
 args = parser.parse_args()
 
@@ -57,6 +61,12 @@ GRACE = args.gracetime
 n_epochs = args.gens
 MAX_EPISODE_LENGTH = args.max_episode_length
 res_filepath = args.res_filepath
+assert args.n_workers >= 1
+assert args.reference_mode in REFERENCE_MODES
+# Each worker evaluates a chunk of CHUNK_SIZE solutions per generation, workers that would get no solution are not started.
+CHUNK_SIZE = -(-POPSIZE // args.n_workers)
+N_WORKERS = -(-POPSIZE // CHUNK_SIZE)
+assert N_WORKERS == 1 or method in ("constant", "bestasref"), "The tgrace experiments log from the process that evaluates the solutions, use n_workers = 1."
 
 MAX_OPTIMIZATION_TIME_TGRACE_EXP = args.max_optimization_time / 4
 
@@ -68,24 +78,66 @@ if method == "tgraceexpdifferentvals":
     res_filepath = "/dev/null"
 
 
-REF_CUMULATIVE_FITNESSES = np.array([-1e20] * MAX_EPISODE_LENGTH)
+# The reference, the step counters and the runtimes of the last generation are in shared memory, so that
+# they are the same in all the worker processes (forked from this one). The observed curve in STOPPER is per process.
+SHARED_REF = SharedGESPReference(MAX_EPISODE_LENGTH, n_episode_slots=POPSIZE)
+# Methods without early stopping get a grace period longer than the episode, so that the stopper never fires.
+TIME_INDEXED = args.gracetime_seconds is not None and method == "bestasref"
+if TIME_INDEXED:
+    assert N_WORKERS == 1 and not args.adaptive_tgrace and args.reference_mode == "asynchronous", "--gracetime_seconds is only supported with one worker, a fixed grace time and the asynchronous reference mode."
+    STOPPER = TimeGESPStopper(MAX_EPISODE_LENGTH + 1, args.gracetime_seconds, tolerance=args.tolerance)
+elif args.adaptive_tgrace and method == "bestasref":
+    # t_grace and the audit counters are per process, they would drift apart in each worker
+    assert N_WORKERS == 1, "--adaptive_tgrace is only supported with one worker."
+    STOPPER = AdaptiveGESPStopper(MAX_EPISODE_LENGTH, GRACE, reference=SHARED_REF, reference_mode=args.reference_mode, tolerance=args.tolerance, seed=seed)
+else:
+    STOPPER = GESPStopper(MAX_EPISODE_LENGTH, GRACE if method in ("bestasref","tgraceexpdifferentvals") else MAX_EPISODE_LENGTH, reference=SHARED_REF, reference_mode=args.reference_mode, tolerance=args.tolerance)
 batch_size = 1
 
 print("----")
 print(args)
 print("----")
 
-EPISODE_INDEX = 0
 
-def rollout(self):
+class GESPWorker(DefaultWorker):
+    """
+    DefaultWorker that applies GESP in each episode.
+
+    The agent update can also be a list of parameter vectors (see PopulationCMAES), in which case
+    each episode evaluates the next one in the list. The episodes after the end of the list are padding:
+    they repeat the last vector and are stopped after the first step.
+    """
+
+    def __init__(self, *, seed, max_episode_length, worker_number):
+        super().__init__(seed=seed, max_episode_length=max_episode_length, worker_number=worker_number)
+        self._param_queue = None
+        self._param_queue_idx = 0
+        self._is_padding = False
+
+    def update_agent(self, agent_update):
+        if isinstance(agent_update, list):
+            self._param_queue = agent_update
+            self._param_queue_idx = 0
+        else:
+            self._param_queue = None
+            super().update_agent(agent_update)
+
+    def start_episode(self):
+        if self._param_queue is not None:
+            self._is_padding = self._param_queue_idx >= len(self._param_queue)
+            self.agent.set_param_values(self._param_queue[min(self._param_queue_idx, len(self._param_queue) - 1)])
+            self._param_queue_idx += 1
+        super().start_episode()
+
+    def rollout(self):
+        return gesp_rollout(self)
+
+
+def gesp_rollout(self):
     print("Begin custom rollout")
     
-    global REF_CUMULATIVE_FITNESSES
     global GRACE
-    global RUNTIMES
     global START_REF_TIME
-    global TOTAL_COMPUTED_STEPS
-    global EPISODE_INDEX
 
     if DTU:
         self.env._env.env._terminate_when_unhealthy = False
@@ -97,71 +149,68 @@ def rollout(self):
     sum_of_rewards = 0
     episode_start_ref_t = time.time()
     self.start_episode()
-    observed_cum_rewards = np.zeros_like(REF_CUMULATIVE_FITNESSES)
+    if self._is_padding:
+        # Discarded by PopulationCMAES, so it is neither recorded nor compared with the reference
+        self._max_episode_length = 1
+        while not self.step_episode():
+            pass
+        self._max_episode_length = MAX_EPISODE_LENGTH
+        return self.collect_episode()
+    STOPPER.reset()
     i = -1
     self._max_episode_length = MAX_EPISODE_LENGTH
-    was_early_stopped = False
     while not self.step_episode():
         i += 1
-        step_reward = self._env_steps[i-1].reward
-        sum_of_rewards = sum_of_rewards + step_reward
-        observed_cum_rewards[i] = sum_of_rewards
-
+        sum_of_rewards = sum_of_rewards + self._env_steps[i-1].reward
 
         # Halt computation cumulative reward is worse than ref
-        if method in ("bestasref","tgraceexpdifferentvals"):
-            if i >= GRACE and not (   max(observed_cum_rewards[i - GRACE], observed_cum_rewards[i]) >=  min(REF_CUMULATIVE_FITNESSES[i - GRACE], REF_CUMULATIVE_FITNESSES[i])  ):
-                print("Stop computation after", i," steps: ref , sum of returns =  ", REF_CUMULATIVE_FITNESSES[i - GRACE], sum_of_rewards)
-                was_early_stopped = True
-                self._max_episode_length = self._eps_length
-    
+        if STOPPER.observe(time.time() - episode_start_ref_t if TIME_INDEXED else i, sum_of_rewards):
+            print("Stop computation after", i," steps: sum of returns =  ", sum_of_rewards)
+            self._max_episode_length = self._eps_length
+    was_early_stopped = STOPPER.was_early_stopped
+
     self._max_episode_length = MAX_EPISODE_LENGTH       
 
-    TOTAL_COMPUTED_STEPS += i
+    total_computed_steps = SHARED_REF.total_steps + i
 
 
     print("f =",sum_of_rewards)
 
     if method == "tgraceexp":
         assert not was_early_stopped, "tgraceexp_nokill experiment requires that early stopping is not applied."
-        tgraceexp.log_values(observed_cum_rewards[:i])
+        tgraceexp.log_values(STOPPER.observed[:i])
         if tgraceexp.toc() > MAX_OPTIMIZATION_TIME_TGRACE_EXP:
             exit(0)
 
     if method == "tgraceexpdifferentvals":
         assert tgraceexpdifferentvals.max_optimization_time == MAX_OPTIMIZATION_TIME_TGRACE_EXP
         if tgraceexpdifferentvals.toc() > MAX_OPTIMIZATION_TIME_TGRACE_EXP:
-            tgraceexpdifferentvals.log_values(-1e10, TOTAL_COMPUTED_STEPS)
+            tgraceexpdifferentvals.log_values(-1e10, total_computed_steps)
             exit(0)
         if not was_early_stopped:
-            tgraceexpdifferentvals.log_values(sum_of_rewards, TOTAL_COMPUTED_STEPS)
+            tgraceexpdifferentvals.log_values(sum_of_rewards, total_computed_steps)
 
 
     # Updating ref fitness.
-    if not was_early_stopped and sum_of_rewards > REF_CUMULATIVE_FITNESSES[-1]:
+    if STOPPER.commit(sum_of_rewards):
         print("--Updating refs--")
-        print("Old refs:", REF_CUMULATIVE_FITNESSES)
-        REF_CUMULATIVE_FITNESSES[0:i] = observed_cum_rewards[0:i]
-        REF_CUMULATIVE_FITNESSES[i:] = sum_of_rewards
-        print("New refs:", REF_CUMULATIVE_FITNESSES)
+        print("New refs:", STOPPER.ref)
         print("--")
 
 
-    RUNTIMES.append(time.time() - episode_start_ref_t)
+    episode_index = SHARED_REF.record_episode(i, time.time() - episode_start_ref_t)
 
-    if EPISODE_INDEX%POPSIZE == POPSIZE-1:
-        runtimes = "("+";".join(map(str, RUNTIMES))+")"
+    if episode_index%POPSIZE == POPSIZE-1:
+        if N_WORKERS == 1 and STOPPER.end_generation():
+            print("--Updating refs at the end of the generation--")
+        if isinstance(STOPPER, AdaptiveGESPStopper):
+            print("t_grace =", STOPPER.t_grace, "after", STOPPER.n_audits, "audit episodes and", STOPPER.n_audit_misses, "misses.")
+        runtimes = "("+";".join(map(str, SHARED_REF.episode_runtimes))+")"
         with open(res_filepath, "a+") as f:
-            print("seed_"+str(seed)+"_gymEnvName_"+gymEnvName, REF_CUMULATIVE_FITNESSES[-1], time.time() - START_REF_TIME, TOTAL_COMPUTED_STEPS, EPISODE_INDEX, runtimes , file=f, sep=",", end="\n")
-        RUNTIMES = []
-
+            print("seed_"+str(seed)+"_gymEnvName_"+gymEnvName, STOPPER.best_value(), time.time() - START_REF_TIME, SHARED_REF.total_steps, episode_index, runtimes , file=f, sep=",", end="\n")
 
-    EPISODE_INDEX += 1
     return self.collect_episode()
 
-# mock rollout function to introduce early stopping
-garage.sampler.default_worker.DefaultWorker.rollout = rollout
-
 @wrap_experiment(snapshot_mode="none", log_dir="/tmp/", archive_launch_repo=False)
 def launch_experiment(ctxt=None, gymEnvName=gymEnvName, seed=seed):
     import garage.trainer
@@ -171,13 +220,40 @@ def launch_experiment(ctxt=None, gymEnvName=gymEnvName, seed=seed):
     from garage.envs import GymEnv
     from garage.experiment.deterministic import set_seed
     from garage.np.algos import CMAES
-    from garage.sampler import LocalSampler
+    from garage.sampler import LocalSampler, MultiprocessingSampler
+    from garage import EpisodeBatch, log_performance
+    import cma
     from garage.tf.policies import CategoricalMLPPolicy, ContinuousMLPPolicy
     from garage.trainer import TFTrainer
 
 
     set_seed(seed)
 
+    class PopulationCMAES(CMAES):
+        """
+        CMAES that evaluates the whole population with a single call to the sampler, instead of one
+        episode per call. Each worker evaluates CHUNK_SIZE solutions (the last worker gets fewer, and
+        its remaining episodes are padding, see GESPWorker, that is discarded).
+        """
+
+        def train(self, trainer):
+            self._es = cma.CMAEvolutionStrategy(self.policy.get_param_values(), self._sigma0, {'popsize': self._n_samples})
+            last_return = None
+            for epoch in trainer.step_epochs():
+                params = self._es.ask()
+                chunks = [params[w*CHUNK_SIZE:(w+1)*CHUNK_SIZE] for w in range(N_WORKERS)]
+                episodes = self._sampler.obtain_exact_episodes(CHUNK_SIZE, agent_update=chunks).split()
+                if STOPPER.end_generation():
+                    print("--Updating refs at the end of the generation--")
+                # Episodes are ordered by worker, so the padded ones are the last ones.
+                episodes = EpisodeBatch.concatenate(*episodes[:self._n_samples])
+                returns = log_performance(trainer.step_itr, episodes, discount=self._discount)
+                self._es.tell(params, -np.array(returns))
+                self.policy.set_param_values(self._es.best.get()[0])
+                last_return = np.mean(returns)
+                trainer.step_itr += 1
+            return last_return
+
     with TFTrainer(ctxt) as trainer:
         global MAX_EPISODE_LENGTH
         if DTU: # DTU  means "Disable terminate_when_unhealthy"
@@ -191,13 +267,20 @@ def launch_experiment(ctxt=None, gymEnvName=gymEnvName, seed=seed):
             policy = CategoricalMLPPolicy(name='policy', env_spec=env.spec, hidden_sizes=(32, 32))
         else:
             policy = ContinuousMLPPolicy(name='policy', env_spec=env.spec, hidden_sizes=(32, 32))
-        sampler = LocalSampler(agents=policy, envs=env, max_episode_length=env.spec.max_episode_length, is_tf_worker=True)
-        algo = CMAES(env_spec=env.spec, policy=policy, sampler=sampler, n_samples=POPSIZE)
+        if N_WORKERS == 1:
+            sampler = LocalSampler(agents=policy, envs=env, max_episode_length=env.spec.max_episode_length, is_tf_worker=True, worker_class=GESPWorker)
+            algo = CMAES(env_spec=env.spec, policy=policy, sampler=sampler, n_samples=POPSIZE)
+        else:
+            sampler = MultiprocessingSampler(agents=policy, envs=env, max_episode_length=env.spec.max_episode_length, is_tf_worker=True, worker_class=GESPWorker, n_workers=N_WORKERS)
+            algo = PopulationCMAES(env_spec=env.spec, policy=policy, sampler=sampler, n_samples=POPSIZE)
 
         trainer.setup(algo, env)
         trainer.train(n_epochs=n_epochs, batch_size=batch_size)
 
 
 if __name__ == "__main__":
-    launch_experiment(seed=seed)
+    try:
+        launch_experiment(seed=seed)
+    finally:
+        SHARED_REF.unlink()
     
@@ -0,0 +1,169 @@
+import numpy as np
+from neat.graphs import feed_forward_layers
+
+
+# Vectorized versions of the activation functions in neat.activations (same clipping). Module level functions, so
+# that a CompiledNetwork can be pickled (e.g. sent to a worker process).
+def _sigmoid(z):
+    return 1.0 / (1.0 + np.exp(-np.clip(5.0 * z, -60.0, 60.0)))
+
+def _tanh(z):
+    return np.tanh(np.clip(2.5 * z, -60.0, 60.0))
+
+def _sin(z):
+    return np.sin(np.clip(5.0 * z, -60.0, 60.0))
+
+def _gauss(z):
+    return np.exp(-5.0 * np.clip(z, -3.4, 3.4) ** 2)
+
+def _relu(z):
+    return np.where(z > 0.0, z, 0.0)
+
+def _softplus(z):
+    return 0.2 * np.log(1.0 + np.exp(np.clip(5.0 * z, -60.0, 60.0)))
+
+def _identity(z):
+    return z
+
+def _clamped(z):
+    return np.clip(z, -1.0, 1.0)
+
+def _inv(z):
+    with np.errstate(divide='ignore'):
+        return np.where(z != 0.0, 1.0 / np.where(z != 0.0, z, 1.0), 0.0)
+
+def _log(z):
+    return np.log(np.maximum(1e-7, z))
+
+def _exp(z):
+    return np.exp(np.clip(z, -60.0, 60.0))
+
+def _hat(z):
+    return np.maximum(0.0, 1.0 - np.abs(z))
+
+def _square(z):
+    return z ** 2
+
+def _cube(z):
+    return z ** 3
+
+NUMPY_ACTIVATIONS = {
+    'sigmoid': _sigmoid,
+    'tanh': _tanh,
+    'sin': _sin,
+    'gauss': _gauss,
+    'relu': _relu,
+    'softplus': _softplus,
+    'identity': _identity,
+    'clamped': _clamped,
+    'inv': _inv,
+    'log': _log,
+    'exp': _exp,
+    'abs': np.abs,
+    'hat': _hat,
+    'square': _square,
+    'cube': _cube,
+}
+
+class CompiledNetwork:
+    """
+    Drop-in replacement of neat.nn.FeedForwardNetwork that evaluates a layer of nodes at a time with NumPy.
+
+    Each layer of feed_forward_layers is a weight matrix over the values it reads (the inputs and the nodes of
+    previous layers that have a connection to it), and the activation is applied to all the nodes of the layer
+    with the same activation function at once. Nodes with an aggregation other than sum are evaluated one by one
+    with the aggregation function of the genome. The outputs match FeedForwardNetwork up to floating point
+    rounding (the order of the sums is different).
+
+    activate_batch(inputs) evaluates several observations (one per row) at once. depends_on_inputs is False if
+    there is no path of enabled connections from an input to an output, in which case the outputs are the
+    same for every observation.
+    """
+
+    def __init__(self, n_inputs:int, n_values:int, output_index:np.ndarray, layers:list, depends_on_inputs:bool=True):
+        self.n_inputs = n_inputs
+        self.n_values = n_values
+        self.output_index = output_index
+        self.layers = layers
+        self.depends_on_inputs = depends_on_inputs
+
+    @staticmethod
+    def create(genome, config):
+        """Compiles genome (a neat.DefaultGenome) into a CompiledNetwork."""
+        genome_config = config.genome_config
+        connections = [cg.key for cg in genome.connections.values() if cg.enabled]
+        layers = feed_forward_layers(genome_config.input_keys, genome_config.output_keys, connections)
+
+        # Position of each node in the vector of values. Outputs that are not in any layer stay 0.0, as in FeedForwardNetwork.
+        index = {key: i for i, key in enumerate(genome_config.input_keys)}
+        for layer in layers:
+            for node in sorted(layer):
+                index[node] = len(index)
+        for node in genome_config.output_keys:
+            if node not in index:
+                index[node] = len(index)
+
+        compiled_layers = []
+        depends_on_inputs = set(range(len(genome_config.input_keys)))
+        for layer in layers:
+            layer = sorted(layer)
+            links = {node: [(index[i], genome.connections[(i, o)].weight) for (i, o) in connections if o == node] for node in layer}
+            depends_on_inputs.update(index[node] for node in layer if any(i in depends_on_inputs for i, _ in links[node]))
+            cols = np.array(sorted(set(i for node in layer for i, _ in links[node])), dtype=np.int64)
+            col_position = {i: j for j, i in enumerate(cols)}
+            weights = np.zeros((len(cols), len(layer)), dtype=np.float64)
+            other_aggregations = []
+            for j, node in enumerate(layer):
+                ng = genome.nodes[node]
+                if ng.aggregation == 'sum':
+                    for i, w in links[node]:
+                        weights[col_position[i], j] += w
+                else:
+                    aggregation = genome_config.aggregation_function_defs.get(ng.aggregation)
+                    other_aggregations.append((j, aggregation, np.array([i for i, _ in links[node]], dtype=np.int64), np.array([w for _, w in links[node]])))
+            activations = []
+            for name in sorted(set(genome.nodes[node].activation for node in layer)):
+                function = NUMPY_ACTIVATIONS.get(name)
+                if function is None:
+                    function = np.vectorize(genome_config.activation_defs.get(name), otypes=[np.float64])
+                activations.append((function, np.array([j for j, node in enumerate(layer) if genome.nodes[node].activation == name], dtype=np.int64)))
+            compiled_layers.append((
+                np.array([index[node] for node in layer], dtype=np.int64),
+                cols,
+                weights,
+                np.array([genome.nodes[node].bias for node in layer]),
+                np.array([genome.nodes[node].response for node in layer]),
+                activations,
+                other_aggregations,
+            ))
+
+        output_index = np.array([index[node] for node in genome_config.output_keys], dtype=np.int64)
+        return CompiledNetwork(len(genome_config.input_keys), len(index), output_index, compiled_layers, any(i in depends_on_inputs for i in output_index))
+
+    def _evaluate(self, values:np.ndarray) -> np.ndarray:
+        # values is (n_values,) or (n_observations x n_values), with the inputs already set
+        for nodes, cols, weights, bias, response, activations, other_aggregations in self.layers:
+            s = values[..., cols] @ weights
+            for j, aggregation, links, w in other_aggregations:
+                s[..., j] = np.reshape([aggregation(list(row)) for row in np.atleast_2d(values[..., links] * w)], s.shape[:-1])
+            z = bias + response * s
+            for function, js in activations:
+                values[..., nodes[js]] = function(z[..., js])
+        return values[..., self.output_index]
+
+    def activate_batch(self, inputs:np.ndarray) -> np.ndarray:
+        """Outputs (n_observations x n_outputs) for inputs (n_observations x n_inputs)."""
+        inputs = np.asarray(inputs, dtype=np.float64)
+        if inputs.ndim != 2 or inputs.shape[1] != self.n_inputs:
+            raise RuntimeError("Expected {0:n} inputs, got {1}".format(self.n_inputs, inputs.shape))
+        values = np.zeros((inputs.shape[0], self.n_values), dtype=np.float64)
+        values[:, :self.n_inputs] = inputs
+        return self._evaluate(values)
+
+    def activate(self, inputs) -> list:
+        """Same as FeedForwardNetwork.activate: the list of outputs for a single observation."""
+        if len(inputs) != self.n_inputs:
+            raise RuntimeError("Expected {0:n} inputs, got {1:n}".format(self.n_inputs, len(inputs)))
+        values = np.zeros(self.n_values, dtype=np.float64)
+        values[:self.n_inputs] = inputs
+        return self._evaluate(values).tolist()
@@ -0,0 +1,32 @@
+import queue
+import gym
+
+
+class EmulatorPool:
+    """
+    Long-lived Super Mario environments, reused across genomes and generations.
+
+    The environments are created with persistent=True, so env.reset() restarts the level in the
+    fceux that is already running instead of launching a new one (fceux is only launched on the
+    first reset, or again if it died). The level is restarted from a savestate of its first
+    controllable frame, so the title screen and intro are only played once per emulator. fceux
+    only sends the tiles and the distance, which is all Train uses. Get an environment with acquire() and give it back with
+    release(env) instead of closing it.
+    """
+
+    def __init__(self, env_id:str, size:int=1):
+        self.env_id = env_id
+        self.envs = [gym.make(env_id, persistent=True, savestates=True, compact=True, channels=('tiles', 'distance')) for _ in range(size)]
+        self._free = queue.Queue()
+        for env in self.envs:
+            self._free.put(env)
+
+    def acquire(self):
+        return self._free.get()
+
+    def release(self, env):
+        self._free.put(env)
+
+    def close(self):
+        for env in self.envs:
+            env.close()
@@ -19,6 +19,17 @@ parser.add_argument('--resultfilename', metavar='resultfilename', type=str, help
 parser.add_argument('--fincrementsize', metavar='fincrementsize', type=int, help='Fitness funcion can only increase in increments of fincrementsize.', default=None, nargs='?')
 parser.add_argument('--task', metavar='task', type=str, help='Which level to run, Eg. 1-1.', nargs='?')
 parser.add_argument('--max_optimization_time', metavar='max_optimization_time', type=float, help='Max runtime for experiment', default=None, nargs='?')
+parser.add_argument('--reference_mode', metavar='reference_mode', type=str, help='When a better episode becomes the GESP reference: asynchronous or generation-synchronous.', default="asynchronous", nargs='?')
+parser.add_argument('--tolerance', metavar='tolerance', type=float, help='Tolerance margin of GESP.', default=0.0, nargs='?')
+parser.add_argument('--adaptive_tgrace', action='store_true', help='Retune the grace time during the run with audit episodes (only with bestasref).')
+parser.add_argument('--emulator_gesp', action='store_true', help='Check the GESP stopping rule in the emulator instead of after each step in python.')
+parser.add_argument('--action_repeat', metavar='action_repeat', type=int, help='Number of frames each action of the network is used for.', default=1, nargs='?')
+parser.add_argument('--action_cache_size', metavar='action_cache_size', type=int, help='Number of tile grids whose action is cached in each episode (0 disables the cache).', default=0, nargs='?')
+parser.add_argument('--cache_constant_networks', action='store_true', help='Replay the cached episode of networks whose action does not depend on the observation, instead of running the emulator.')
+parser.add_argument('--cache_genome_fitness', action='store_true', help='Replay the cached episode of genomes already evaluated (e.g. elites) instead of running the emulator.')
+parser.add_argument('--prefix_cache_interval', metavar='prefix_cache_interval', type=int, help='Steps between the savestates of the action prefix cache (0 disables the cache).', default=0, nargs='?')
+parser.add_argument('--prefix_cache_states', metavar='prefix_cache_states', type=int, help='Maximum number of savestates kept by the action prefix cache of each emulator.', default=1000, nargs='?')
+parser.add_argument('--n_workers', metavar='n_workers', type=int, help='Number of processes (with an emulator each) that evaluate the genomes.', default=1, nargs='?')
 
 
 args = parser.parse_args()
@@ -30,7 +41,7 @@ if (args.mode.upper() == "TRAIN" or args.mode.upper() == "CONT_TRAIN") and args.
 
 
 if args.mode.upper() == "TRAIN":
-    t = t.Train(args.method, args.gen, args.seed, args.resultfilename, args.task, args.gracetime, args.fincrementsize, experiment_index_for_log=args.experiment_index_for_log, max_optimization_time=args.max_optimization_time)
+    t = t.Train(args.method, args.gen, args.seed, args.resultfilename, args.task, args.gracetime, args.fincrementsize, experiment_index_for_log=args.experiment_index_for_log, max_optimization_time=args.max_optimization_time, reference_mode=args.reference_mode, adaptive_tgrace=args.adaptive_tgrace, tolerance=args.tolerance, emulator_gesp=args.emulator_gesp, action_repeat=args.action_repeat, n_workers=args.n_workers, action_cache_size=args.action_cache_size, cache_constant_networks=args.cache_constant_networks, cache_genome_fitness=args.cache_genome_fitness, prefix_cache_interval=args.prefix_cache_interval, prefix_cache_states=args.prefix_cache_states)
     t.main(config_file=args.config)
 
 elif args.mode.upper() == "RUN":
@@ -0,0 +1,179 @@
+from collections import OrderedDict
+from gym.utils import seeding
+
+
+class _Node:
+    __slots__ = ("parent", "key", "children", "result", "state_id", "depth")
+
+    def __init__(self, parent, key, result):
+        self.parent = parent
+        self.key = key
+        self.children = {}
+        self.result = result
+        self.state_id = None
+        self.depth = 0 if parent is None else parent.depth + 1
+
+    def path(self):
+        nodes = []
+        node = self
+        while node is not None:
+            nodes.append(node)
+            node = node.parent
+        return nodes[::-1]
+
+
+class PrefixCachedEnv:
+    """
+    Trie of the action sequences played in a persistent Super Mario environment (see EmulatorPool).
+
+    The episode is deterministic given the noop at its start and the actions, so each node of the trie keeps the
+    result of env.step (observation, reward, done, info) after the actions on its path, with a root for each noop.
+    While the actions of an episode follow the trie, step() returns the cached results and fceux is not used.
+    When an action leaves the trie, fceux is moved to the current node: the deepest savestate on its path is
+    loaded (savestates are taken every state_interval steps) and the steps after it are played again, or the level
+    is restarted if there is none.
+
+    At most max_states savestates and max_nodes nodes are kept, the least recently used are dropped. cached_steps,
+    simulated_steps and replayed_steps count the steps returned from the trie, played for new nodes and played
+    again to reach a node.
+    """
+
+    def __init__(self, env, state_interval:int, max_states:int=1000, max_nodes:int=100000):
+        assert state_interval > 0
+        self.env = env
+        self.state_interval = state_interval
+        self.max_states = max_states
+        self.max_nodes = max_nodes
+        self.roots = {}
+        self.nodes = OrderedDict()
+        self.states = OrderedDict()
+        self.next_state_id = 0
+        self.fceux_pid = None
+        self.noop = None
+        self.node = None
+        self.synced = None
+        self.cached_steps = 0
+        self.simulated_steps = 0
+        self.replayed_steps = 0
+
+    def reset(self):
+        # The nodes of the last episode are the most recently used ones (ancestors after descendants)
+        if self.node is not None:
+            for node in self.node.path()[::-1]:
+                self.nodes.move_to_end(node)
+        self._evict_nodes()
+
+        # Same noop as the env would draw on its first step
+        env = self.env.unwrapped
+        env.curr_seed = seeding.hash_seed(env.curr_seed) % 256
+        self.noop = env.curr_seed
+        root = self.roots.get(self.noop)
+        if root is None:
+            state = self._restart()
+            root = _Node(None, self.noop, (state, 0, False, {}))
+            self.roots[self.noop] = root
+            self.nodes[root] = None
+            self.synced = root
+        self.node = root
+        return root.result[0]
+
+    def step(self, action, repeat:int=1):
+        key = (tuple(action), repeat)
+        child = self.node.children.get(key)
+        if child is not None:
+            self.cached_steps += 1
+            self.node = child
+            return child.result
+        if self.synced is not self.node and not self._sync():
+            return self.node.result[0], 0, True, {'ignore': True}
+        state, reward, done, info = self._env_step(key)
+        if info.get('ignore', False):
+            self.synced = None
+            return state, reward, done, info
+        self.simulated_steps += 1
+        child = _Node(self.node, key, (state, reward, done, dict(info)))
+        self.node.children[key] = child
+        self.nodes[child] = None
+        self.node = child
+        self.synced = child
+        if not done and child.depth % self.state_interval == 0:
+            self._save_state(child)
+        return child.result
+
+    def step_counts(self):
+        return self.cached_steps, self.simulated_steps, self.replayed_steps
+
+    def _env_step(self, key):
+        # info['ignore'] is also set if fceux was relaunched during the step (the result is not the one of the node)
+        action, repeat = key
+        if repeat == 1:
+            state, reward, done, info = self.env.step(list(action))
+        else:
+            state, reward, done, info = self.env.unwrapped.step(list(action), repeat)
+        if self.env.unwrapped.fceux_pid != self.fceux_pid:
+            return state, reward, True, {'ignore': True}
+        return state, reward, done, info
+
+    def _restart(self):
+        state = self.env.reset()
+        self.env.unwrapped.noop = self.noop
+        self._check_fceux()
+        return state
+
+    def _check_fceux(self):
+        # The savestates are lost if fceux was relaunched
+        if self.env.unwrapped.fceux_pid != self.fceux_pid:
+            self.fceux_pid = self.env.unwrapped.fceux_pid
+            for node in self.states:
+                node.state_id = None
+            self.states.clear()
+
+    def _sync(self):
+        """Brings fceux to self.node. Returns False if fceux failed on the way."""
+        self._check_fceux()
+        path = self.node.path()
+        start = 0
+        for i in range(len(path) - 1, 0, -1):
+            if path[i].state_id is not None:
+                start = i
+                break
+        if start > 0:
+            self.states.move_to_end(path[start])
+            self.env.unwrapped.load_state(path[start].state_id)
+        else:
+            self._restart()
+        for node in path[start + 1:]:
+            self.replayed_steps += 1
+            if self._env_step(node.key)[3].get('ignore', False):
+                self.synced = None
+                return False
+        self.synced = self.node
+        return True
+
+    def _save_state(self, node):
+        node.state_id = self.next_state_id
+        self.next_state_id += 1
+        self.env.unwrapped.save_state(node.state_id)
+        self.states[node] = None
+        while len(self.states) > self.max_states:
+            self._drop_state(next(iter(self.states)))
+
+    def _drop_state(self, node):
+        self.env.unwrapped.drop_state(node.state_id)
+        node.state_id = None
+        del self.states[node]
+
+    def _evict_nodes(self):
+        while len(self.nodes) > self.max_nodes:
+            node = next(iter(self.nodes))
+            if node.parent is None:
+                del self.roots[node.key]
+            else:
+                del node.parent.children[node.key]
+            stack = [node]
+            while len(stack) > 0:
+                node = stack.pop()
+                stack.extend(node.children.values())
+                del self.nodes[node]
+                if node.state_id is not None:
+                    self._drop_state(node)
@@ -4,6 +4,7 @@ import sys
 sys.path.append("other_RL/gym-super-mario-master")
 import gym, ppaquette_gym_super_mario
 import visualize
+from compiled_network import CompiledNetwork
 import gzip
 import neat.genome
 from joblib import Parallel, delayed
@@ -31,7 +32,7 @@ def main(config_file, file, level=LEVEL):
                          config_file)
     genome = pickle.load(open(file, 'rb'))
     env = gym.make('ppaquette/SuperMarioBros-'+level+'-Tiles-v0')
-    net = neat.nn.FeedForwardNetwork.create(genome, config)
+    net = CompiledNetwork.create(genome, config)
     info = {'distance': 0}
     try:
         state = env.reset()
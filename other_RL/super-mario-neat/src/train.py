@@ -9,18 +9,27 @@ import multiprocessing as mp
 import time
 import numpy as np
 import random
+import hashlib
+import queue
+import traceback
+from collections import OrderedDict
 sys.path.append(os.path.abspath('scripts/utils'))
 sys.path.append(os.path.abspath('scripts'))
 from progress_tracker import experimentProgressTracker
 import src_tgrace_experiment
+from gesp import GESPStopper, AdaptiveGESPStopper, SharedGESPReference
+from emulator_pool import EmulatorPool
+from compiled_network import CompiledNetwork
+from prefix_cache import PrefixCachedEnv
 
 gym.logger.set_level(40)
 
 FITNESS_REF_ARRAY_SIZE = 1001
 MAX_EPISODE_LENGTH = 1000
+MAX_EPISODE_ATTEMPTS = 3
 
 class Train:
-    def __init__(self, method:str, generations:int, seed:int, filename:str, level:str="1-1", gracetime:int=None,  fincrementsize:int=None, experiment_index_for_log=None, max_optimization_time=None):
+    def __init__(self, method:str, generations:int, seed:int, filename:str, level:str="1-1", gracetime:int=None,  fincrementsize:int=None, experiment_index_for_log=None, max_optimization_time=None, reference_mode:str="asynchronous", adaptive_tgrace:bool=False, tolerance:float=0.0, emulator_gesp:bool=False, action_repeat:int=1, n_workers:int=1, action_cache_size:int=0, cache_constant_networks:bool=False, cache_genome_fitness:bool=False, prefix_cache_interval:int=0, prefix_cache_states:int=1000):
         self.actions = [
             [0, 0, 0, 1, 0, 1],
             [0, 0, 0, 1, 1, 1],
@@ -36,9 +45,6 @@ class Train:
         self.level = level
         self.max_optimization_time = max_optimization_time
         self.experiment_index_for_log = experiment_index_for_log
-        self.observed_fitnesses = np.zeros(FITNESS_REF_ARRAY_SIZE, dtype=np.int64)
-        print("zeroe ref fitnesses.")
-        self.ref_fitnesses = np.zeros(FITNESS_REF_ARRAY_SIZE, dtype=np.int64)
         self.total_frames = 0
         self.evals = 0
         self.frames_in_gen = []
@@ -49,6 +55,48 @@ class Train:
         self.method = method
         self.time_grace = gracetime
         self.fincrementsize = fincrementsize
+        # fceux checks the GESP rule itself (same rule and step as self.stopper) and finishes the episode when it fires
+        self.emulator_gesp = emulator_gesp
+        # Each action of the network is used for action_repeat frames, sent to the emulator in a single message.
+        # The distance of every frame is still observed by the stopper.
+        self.action_repeat = action_repeat
+        # With n_workers > 1 the genomes are evaluated in n_workers processes with a persistent emulator each, and the
+        # reference lives in shared memory. The episodes are committed to it in this process (see _eval_genomes).
+        self.n_workers = n_workers
+        assert n_workers >= 1
+        # The network is deterministic: the action for each tile grid seen in an episode is kept in an LRU cache of
+        # action_cache_size grids (0 to disable it). The hit rate is printed after each generation.
+        self.action_cache_size = action_cache_size
+        self.action_cache_hits = 0
+        self.action_cache_lookups = 0
+        # Networks without a path from the inputs to the outputs always choose the same action, and the episode only
+        # depends on that action and the level. The distance curve of the first of these episodes (for each action) is
+        # kept, and the later ones are replayed from it through the stopper without the emulator. The frames of the
+        # replayed episodes are counted in cached_frames instead of total_frames.
+        self.cache_constant_networks = cache_constant_networks
+        # The same for genomes identical to one already evaluated in the level (e.g. the elites of NEAT), by a digest of
+        # their genes. Only the genomes of the last generation are kept, elites are the only repeats in practice.
+        self.cache_genome_fitness = cache_genome_fitness
+        self.cached_episodes = {}
+        self.genome_keys_in_gen = set()
+        self.cached_frames = 0
+        self.simulated_frames = 0
+        # With prefix_cache_interval > 0, each emulator is used through a PrefixCachedEnv: the steps of action sequences
+        # already played are taken from a trie, with a savestate every prefix_cache_interval steps (at most
+        # prefix_cache_states of them). The steps from the trie, simulated and played again are printed per generation.
+        self.prefix_cache_interval = prefix_cache_interval
+        self.prefix_cache_states = prefix_cache_states
+        self.prefix_caches = {}
+        self.prefix_cache_counts = np.zeros(3, dtype=np.int64)
+        assert not (prefix_cache_interval > 0 and emulator_gesp), "The GESP check in the emulator does not know the steps taken from the prefix cache."
+        assert not (n_workers > 1 and adaptive_tgrace), "The adaptive t_grace requires n_workers = 1."
+        assert not (n_workers > 1 and emulator_gesp and reference_mode == "asynchronous"), "The emulator only gets the reference at the start of the episode, use reference_mode generation-synchronous or n_workers = 1."
+        self.shared_ref = SharedGESPReference(FITNESS_REF_ARRAY_SIZE, initial_value=0) if n_workers > 1 else None
+        # Only bestasref stops early, the rest of the methods get a grace period longer than the episode.
+        if adaptive_tgrace and method == "bestasref":
+            self.stopper = AdaptiveGESPStopper(FITNESS_REF_ARRAY_SIZE, gracetime, initial_value=0, reference_mode=reference_mode, tolerance=tolerance, seed=int(seed))
+        else:
+            self.stopper = GESPStopper(FITNESS_REF_ARRAY_SIZE, gracetime if method in ("bestasref","tgraceexpdifferentvals") else FITNESS_REF_ARRAY_SIZE, initial_value=0, reference=self.shared_ref, reference_mode=reference_mode, tolerance=tolerance)
         if method == "tgraceexp":
             self.tgraceexp = src_tgrace_experiment.TgraceNokillLogger(filename, max_optimization_time, True, 1)
             self.filename = "/dev/null"
@@ -59,92 +107,279 @@ class Train:
             self.is_tgraceexpdifferentvals = True
         else:
             self.is_tgraceexpdifferentvals = False
+        self.env_id = 'ppaquette/SuperMarioBros-'+self.level+'-Tiles-v0'
+        self.emulators = EmulatorPool(self.env_id) if n_workers == 1 else None
+        self.workers = []
 
 
     def _get_actions(self, a):
         return self.actions[a.index(max(a))]
 
-    def _fitness_func(self, genome, config, o = None):
-        env = gym.make('ppaquette/SuperMarioBros-'+self.level+'-Tiles-v0')
-        # env.configure(lock=self.lock)
+    def _get_cached_actions(self, net, state, action_cache):
+        key = state.tobytes()
+        self.action_cache_lookups += 1
+        output = action_cache.get(key)
+        if output is None:
+            output = self._get_actions(net.activate(state))
+            action_cache[key] = output
+            if len(action_cache) > self.action_cache_size:
+                action_cache.popitem(last=False)
+        else:
+            action_cache.move_to_end(key)
+            self.action_cache_hits += 1
+        return output
+
+    def _play_episode(self, env, net, stopper):
+        """Evaluates net (the CompiledNetwork of a genome) in env. Returns the last distance, the number of frames and the frames to add to total_frames."""
+        if self.prefix_cache_interval > 0:
+            if env not in self.prefix_caches:
+                self.prefix_caches[env] = PrefixCachedEnv(env, self.prefix_cache_interval, self.prefix_cache_states)
+            env = self.prefix_caches[env]
+            counts = np.array(env.step_counts())
         try:
-            state = env.reset()
-            net = neat.nn.FeedForwardNetwork.create(genome, config)
-            done = False
-            i = 0
-            old = 0
-            self.evals += 1
-            self.observed_fitnesses[:] = 0
-            np.set_printoptions(threshold=sys.maxsize)
+            for _ in range(MAX_EPISODE_ATTEMPTS):
+                res = self._try_episode(env, net, stopper)
+                if res is not None:
+                    return res
+                print("fceux died or hung, playing the episode again.")
+            raise gym.error.Error("fceux failed in " + str(MAX_EPISODE_ATTEMPTS) + " attempts of the same episode.")
+        finally:
+            if self.prefix_cache_interval > 0:
+                self.prefix_cache_counts += np.array(env.step_counts()) - counts
 
-            while not done:
-                self.total_frames += i
+    def _try_episode(self, env, net, stopper):
+        # Returns None if the episode was interrupted because fceux died or hung (the env relaunches it)
+        state = env.reset()
+        done = False
+        i = 0
+        old = 0
+        total_frames = 0
+        stopper.reset()
+        if self.emulator_gesp:
+            stops_early = self.method == "bestasref" and not getattr(stopper, "is_audit", False)
+            env.unwrapped.send_gesp_reference(stopper.t_grace if stops_early else None, stopper.ref, stopper.tolerance, self.fincrementsize)
+        np.set_printoptions(threshold=sys.maxsize)
+
+        trace = []
+        action_cache = OrderedDict() if self.action_cache_size > 0 else None
+        while not done:
+            total_frames += i
+            if len(trace) == 0:
                 state = state.flatten()
-                output = net.activate(state)
-                output = self._get_actions(output)
-                s, reward, done, info = env.step(output)
-                distance = info['distance'] # the distance is the fitness
-                if not self.fincrementsize is None:
-                    distance = distance - (distance % self.fincrementsize)
-                self.observed_fitnesses[i] = distance
-                state = s
-                i += 1
-                if i > MAX_EPISODE_LENGTH:
+                if action_cache is None:
+                    output = self._get_actions(net.activate(state))
+                else:
+                    output = self._get_cached_actions(net, state, action_cache)
+                if isinstance(env, PrefixCachedEnv):
+                    state, reward, chunk_done, info = env.step(output, self.action_repeat)
+                elif self.action_repeat == 1:
+                    state, reward, chunk_done, info = env.step(output)
+                else:
+                    state, reward, chunk_done, info = env.unwrapped.step(output, self.action_repeat)
+                if info.get('ignore', False):
+                    return None
+                trace = list(info.get('distance_trace') or [info['distance']])
+            distance = trace.pop(0) # the distance is the fitness
+            done = chunk_done and len(trace) == 0
+            if not self.fincrementsize is None:
+                distance = distance - (distance % self.fincrementsize)
+            is_stop_gesp = stopper.observe(i, distance)
+            i += 1
+            if i > MAX_EPISODE_LENGTH:
+                break
+
+            if self.method == "constant":
+                if i % 50 == 0:
+                    if old == distance:
+                        break
+                    else:
+                        old = distance
+            elif self.method == "bestasref":
+                if is_stop_gesp:
                     break
+            elif self.method == "nokill":
+                pass
+            elif self.method == "tgraceexp":
+                pass
+            else:
+                raise ValueError("self.method =" + self.method + "not recognized.")
 
-                if self.method == "constant":
-                    if i % 50 == 0:
-                        if old == distance:
-                            break
-                        else:
-                            old = distance
-                elif self.method == "bestasref":
+        # [print(str(i) + " : " + str(info[i]), end=" ") for i in info.keys()]
+        # print("\n******************************")
+        return distance, i, total_frames
 
-                    # import code
-                    # code.interact(local=locals())
+    def _record_fitness(self, genome, distance, i):
+        # The episode of genome is the current episode of self.stopper
+        self.frames_in_gen.append(i)
+        fitness = -1 if distance <= 40 else distance
+        genome.fitness = fitness
+
+        if self.method == "tgraceexp":
+            assert self.tgraceexp.max_optimization_time == self.max_optimization_time, f"where self.tgraceexp.max_optimization_time = {self.tgraceexp.max_optimization_time} and self.max_optimization_time {self.max_optimization_time} were different"
+            if self.tgraceexp.toc() > self.max_optimization_time:
+                experimentProgressTracker.mark_index_done_external("supermario_tgraceexpnokill", self.experiment_index_for_log)
+            self.tgraceexp.log_values(np.trim_zeros(self.stopper.observed[:i].astype(np.int64), 'b'))
 
-                    if i > self.time_grace and self.ref_fitnesses[i - self.time_grace] > distance:
-                        break
-                elif self.method == "nokill":
-                    pass
-                elif self.method == "tgraceexp":
-                    pass
-                else:
-                    raise ValueError("self.method =" + self.method + "not recognized.")
 
-            # [print(str(i) + " : " + str(info[i]), end=" ") for i in info.keys()]
-            # print("\n******************************")
-            self.frames_in_gen.append(i)
-            fitness = -1 if distance <= 40 else distance
-            genome.fitness = fitness
+        if self.is_tgraceexpdifferentvals:
+            assert self.tgraceexpdifferentvals.max_optimization_time == self.max_optimization_time, f"where self.tgraceexpdifferentvals.max_optimization_time = {self.tgraceexp.max_optimization_time} and self.max_optimization_time {self.max_optimization_time} were different"
+            if self.tgraceexpdifferentvals.toc() > self.max_optimization_time:
+                experimentProgressTracker.mark_index_done_external("supermario_tgraceexpdifferentvals", self.experiment_index_for_log)
+            self.tgraceexpdifferentvals.log_values(fitness, self.total_frames)
 
-            if self.method == "tgraceexp":
-                assert self.tgraceexp.max_optimization_time == self.max_optimization_time, f"where self.tgraceexp.max_optimization_time = {self.tgraceexp.max_optimization_time} and self.max_optimization_time {self.max_optimization_time} were different"
-                if self.tgraceexp.toc() > self.max_optimization_time:
-                    experimentProgressTracker.mark_index_done_external("supermario_tgraceexpnokill", self.experiment_index_for_log)
-                self.tgraceexp.log_values(np.trim_zeros(self.observed_fitnesses, 'b'))
 
+        if self.best_fitness < fitness:
+            self.best_fitness = fitness
+            self.stopper.commit(force=True)
+        else:
+            self.stopper.discard()
+        return fitness
+
+    def _constant_action(self, net):
+        # Index of the action chosen by net for every observation, None if its output depends on them
+        if not self.cache_constant_networks or net.depends_on_inputs:
+            return None
+        output = net.activate(np.zeros(net.n_inputs))
+        return output.index(max(output))
 
-            if self.is_tgraceexpdifferentvals:
-                assert self.tgraceexpdifferentvals.max_optimization_time == self.max_optimization_time, f"where self.tgraceexpdifferentvals.max_optimization_time = {self.tgraceexp.max_optimization_time} and self.max_optimization_time {self.max_optimization_time} were different"
-                if self.tgraceexpdifferentvals.toc() > self.max_optimization_time:
-                    experimentProgressTracker.mark_index_done_external("supermario_tgraceexpdifferentvals", self.experiment_index_for_log)
-                self.tgraceexpdifferentvals.log_values(fitness, self.total_frames)
+    def _episode_cache_key(self, genome, net):
+        # Key of the cached episode of genome (compiled into net): its constant action or its fingerprint, None if it is not cached
+        action = self._constant_action(net)
+        if action is not None:
+            return ("constant", self.level, action)
+        if self.cache_genome_fitness:
+            nodes = sorted(genome.nodes.items())
+            connections = sorted(genome.connections.items())
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update(np.array([(key, ng.bias, ng.response) for key, ng in nodes], dtype=np.float64).tobytes())
+            digest.update(";".join(ng.activation + "," + ng.aggregation for _, ng in nodes).encode())
+            digest.update(np.array([(i, o, cg.weight, cg.enabled) for (i, o), cg in connections], dtype=np.float64).tobytes())
+            key = ("genome", self.level, digest.digest())
+            self.genome_keys_in_gen.add(key)
+            return key
+        return None
 
+    def _replay_cached_episode(self, key):
+        """Plays the cached curve of key through self.stopper. Returns the last distance and the number of frames, or None if the curve is too short."""
+        if key not in self.cached_episodes:
+            return None
+        curve, is_complete = self.cached_episodes[key]
+        self.stopper.reset()
+        old = 0
+        for i, distance in enumerate(curve):
+            is_stop_gesp = self.stopper.observe(i, distance)
+            if i + 1 > MAX_EPISODE_LENGTH:
+                return distance, i + 1
+            if self.method == "constant" and (i + 1) % 50 == 0:
+                if old == distance:
+                    return distance, i + 1
+                old = distance
+            elif self.method == "bestasref" and is_stop_gesp:
+                return distance, i + 1
+        if is_complete:
+            return curve[-1], len(curve)
+        return None
 
-            if self.best_fitness < fitness:
-                self.best_fitness = fitness
-                self.ref_fitnesses[:] = self.observed_fitnesses[:]
-                self.ref_fitnesses[(i-1):] = np.repeat(self.ref_fitnesses[(i-1)], FITNESS_REF_ARRAY_SIZE)[(i-1):]
+    def _store_cached_episode(self, key, observed, was_early_stopped):
+        # A curve that was stopped early by GESP is only kept until a longer one is observed
+        previous = self.cached_episodes.get(key)
+        if previous is None or (not previous[1] and (not was_early_stopped or len(observed) > len(previous[0]))):
+            self.cached_episodes[key] = (np.array(observed), not was_early_stopped)
 
+    def _fitness_func(self, genome, config, o = None):
+        net = CompiledNetwork.create(genome, config)
+        key = self._episode_cache_key(genome, net)
+        replay = None if key is None else self._replay_cached_episode(key)
+        if replay is not None:
+            distance, i = replay
+            self.evals += 1
+            self.cached_frames += i
+            fitness = self._record_fitness(genome, distance, i)
+            if not o is None:
+                o.put(fitness)
+            return
+        env = self.emulators.acquire()
+        # env.configure(lock=self.lock)
+        try:
+            distance, i, total_frames = self._play_episode(env, net, self.stopper)
+            self.evals += 1
+            self.total_frames += total_frames
+            self.simulated_frames += i
+            if key is not None:
+                self._store_cached_episode(key, self.stopper.observed[:i], self.stopper.was_early_stopped)
+            fitness = self._record_fitness(genome, distance, i)
             
             if not o is None:
                 o.put(fitness)
-            env.close()
+            self.emulators.release(env)
         except KeyboardInterrupt:
-            env.close()
+            self.emulators.close()
             exit()
 
+    def _start_workers(self):
+        # Forked processes, each one evaluates the genomes in self.tasks with its own persistent emulator
+        ctx = mp.get_context("fork")
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.workers = [ctx.Process(target=self._worker_loop) for _ in range(self.n_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def _worker_loop(self):
+        emulators = EmulatorPool(self.env_id)
+        env = emulators.acquire()
+        # Only used to stop the episodes, with the reference in shared memory (committed by the main process)
+        stopper = GESPStopper(FITNESS_REF_ARRAY_SIZE, self.stopper.t_grace, initial_value=0, reference=self.shared_ref, reference_mode=self.stopper.reference_mode, tolerance=self.stopper.tolerance)
+        try:
+            for index, net in iter(self.tasks.get, None):
+                self.action_cache_hits = 0
+                self.action_cache_lookups = 0
+                self.prefix_cache_counts[:] = 0
+                try:
+                    distance, i, total_frames = self._play_episode(env, net, stopper)
+                except Exception:
+                    # Sent to the main process, which raises it (see _get_result)
+                    self.results.put((index, traceback.format_exc()))
+                    return
+                self.results.put((index, distance, i, total_frames, stopper.observed[:i].copy(), stopper.was_early_stopped, self.action_cache_hits, self.action_cache_lookups, self.prefix_cache_counts.copy()))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            emulators.close()
+
+    def _get_result(self):
+        # Next result of the workers. Raises if a worker failed or exited, instead of waiting forever.
+        while True:
+            try:
+                result = self.results.get(timeout=5)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError("A worker process exited without sending its result.")
+                continue
+            if len(result) == 2:
+                raise RuntimeError("A worker failed to evaluate genome " + str(result[0]) + ":\n" + result[1])
+            return result
+
+    def _close_emulators(self):
+        if self.emulators is not None:
+            self.emulators.close()
+        # The tasks left (if a worker failed) are not evaluated
+        while len(self.workers) > 0:
+            try:
+                self.tasks.get_nowait()
+            except queue.Empty:
+                break
+        for worker in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout=30)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+        if self.shared_ref is not None:
+            self.shared_ref.unlink()
+            self.shared_ref = None
+
     def _eval_genomes(self, genomes, config):
         idx, genomes = zip(*genomes)
 
@@ -165,11 +400,55 @@ class Train:
         # with open("resultSuperMario.txt", "a") as f:
         #     print("fitnesses", [genomes[i].fitness for i in range(len(genomes))])
 
-        # Sequential
         self.frames_in_gen = []
+        self.action_cache_hits = 0
+        self.action_cache_lookups = 0
+        self.prefix_cache_counts[:] = 0
 
-        for i in range(len(genomes)):
-            self._fitness_func(genomes[i], config)
+        if self.n_workers > 1:
+            # Parallel: the episodes are committed in the order in which they finish. Genomes whose episode is already
+            # cached are replayed here instead. The workers get the compiled networks.
+            n_tasks = 0
+            nets = [CompiledNetwork.create(genomes[i], config) for i in range(len(genomes))]
+            keys = [self._episode_cache_key(genomes[i], nets[i]) for i in range(len(genomes))]
+            for i in range(len(genomes)):
+                replay = None if keys[i] is None else self._replay_cached_episode(keys[i])
+                if replay is None:
+                    self.tasks.put((i, nets[i]))
+                    n_tasks += 1
+                else:
+                    self.evals += 1
+                    self.cached_frames += replay[1]
+                    self._record_fitness(genomes[i], replay[0], replay[1])
+            for _ in range(n_tasks):
+                i, distance, n_frames, total_frames, observed, was_early_stopped, action_cache_hits, action_cache_lookups, prefix_cache_counts = self._get_result()
+                self.prefix_cache_counts += prefix_cache_counts
+                self.action_cache_hits += action_cache_hits
+                self.action_cache_lookups += action_cache_lookups
+                self.evals += 1
+                self.total_frames += total_frames
+                self.simulated_frames += n_frames
+                if keys[i] is not None:
+                    self._store_cached_episode(keys[i], observed, was_early_stopped)
+                self.stopper.reset()
+                self.stopper.load_episode(observed, was_early_stopped)
+                self._record_fitness(genomes[i], distance, n_frames)
+        else:
+            # Sequential
+            for i in range(len(genomes)):
+                self._fitness_func(genomes[i], config)
+        self.stopper.end_generation()
+        for key in [key for key in self.cached_episodes if key[0] == "genome" and key not in self.genome_keys_in_gen]:
+            del self.cached_episodes[key]
+        self.genome_keys_in_gen = set()
+        if isinstance(self.stopper, AdaptiveGESPStopper):
+            print("t_grace =", self.stopper.t_grace, "after", self.stopper.n_audits, "audit episodes and", self.stopper.n_audit_misses, "misses.")
+        if self.cache_constant_networks or self.cache_genome_fitness:
+            print("Frames simulated:", self.simulated_frames, "replayed from cached episodes:", self.cached_frames)
+        if self.prefix_cache_interval > 0:
+            print("Prefix cache:", self.prefix_cache_counts[0], "steps from the trie,", self.prefix_cache_counts[1], "simulated and", self.prefix_cache_counts[2], "played again from a savestate.")
+        if self.action_cache_lookups > 0:
+            print("Action cache hit rate:", round(self.action_cache_hits / self.action_cache_lookups, 4), "in", self.action_cache_lookups, "network activations.")
         
         with open(self.filename, "a") as f:
             runtimes = "("+";".join(map(str, self.frames_in_gen))+")"
@@ -185,7 +464,12 @@ class Train:
         stats = neat.StatisticsReporter()
         p.add_reporter(stats)
         print("loaded checkpoint...")
-        winner = p.run(self._eval_genomes, n)
+        if self.n_workers > 1:
+            self._start_workers()
+        try:
+            winner = p.run(self._eval_genomes, n)
+        finally:
+            self._close_emulators()
         win = p.best_genome
         # pickle.dump(winner, open('winner.pkl', 'wb'))
         pickle.dump(win, open(self.filename.replace(".txt", ".pkl"), 'wb'))
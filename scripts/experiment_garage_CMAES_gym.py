@@ -3,6 +3,7 @@ from statistics import median
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 from utils.UpdateParameter import *
+from utils.tgrace_calibration import load_calibrated_tgrace
 import subprocess
 import time
 import re
@@ -207,6 +208,7 @@ for index, gymEnvName, action_space, max_episode_length, x_max in zip(range(len(
     if sys.argv[1] == "--launch_local":
         import itertools
         import time
+        calibrated_gracetime, tolerance = load_calibrated_tgrace("garagegym" + gymEnvName, gracetime, max_episode_length)
 
 
         def run_with_seed(seed):
@@ -216,7 +218,7 @@ for index, gymEnvName, action_space, max_episode_length, x_max in zip(range(len(
             for method in method_list:
 
                 res_filepath = f"results/data/garage_gym/gymEnvName_{gymEnvName}_{method}_{seed}.txt"
-                bash_cmd = f"python3 other_RL/meta_world_and_garage/test_example_garage_cart_pole_CMA_ES.py --method {method} --gymEnvName {gymEnvName} --action_space={action_space} --seed {seed} --gracetime {gracetime} --gens {gens} --max_episode_length {max_episode_length} --res_filepath {res_filepath}"
+                bash_cmd = f"python3 other_RL/meta_world_and_garage/test_example_garage_cart_pole_CMA_ES.py --method {method} --gymEnvName {gymEnvName} --action_space={action_space} --seed {seed} --gracetime {calibrated_gracetime} --tolerance {tolerance} --gens {gens} --max_episode_length {max_episode_length} --res_filepath {res_filepath}"
                 print(bash_cmd)
                 exec_res=subprocess.run(bash_cmd,shell=True, capture_output=True)
             
@@ -1,6 +1,7 @@
 from argparse import ArgumentError
 import pandas as pd
 from utils.UpdateParameter import *
+from utils.tgrace_calibration import load_calibrated_tgrace
 import subprocess
 import time
 import re
@@ -99,6 +100,7 @@ for task in tqdm(task_list):
 
             seed, method, task = experiment_parameters[experiment_index]
             print(seed, method, task)
+            calibrated_gracetime, tolerance = load_calibrated_tgrace("supermario" + task, gracetime, 1000)
             time.sleep(0.5)
             print(f"Launching with seed {seed} in experiment_halveruntime.py ...")
 
@@ -114,7 +116,7 @@ for task in tqdm(task_list):
                 pass
             except FileNotFoundError:
                 pass
-            cmd_str = f"python3 other_RL/super-mario-neat/src/main.py train --gen 10000 --task {task} --seed {seed} --method {method} --resultfilename {resultfilename} --gracetime {gracetime}"
+            cmd_str = f"python3 other_RL/super-mario-neat/src/main.py train --gen 10000 --task {task} --seed {seed} --method {method} --resultfilename {resultfilename} --gracetime {calibrated_gracetime} --tolerance {tolerance}"
             exec_res=subprocess.run(cmd_str,shell=True, capture_output=True)
         
         Parallel(n_jobs=parallel_threads, verbose=12)(delayed(run_with_experiment_index)(i) for i in range(len(experiment_parameters)))
@@ -156,9 +158,7 @@ for task in tqdm(task_list):
             real_tgrace = max(1,round(t_max_episode_length * tgrace))
             print(seed, tgrace, task)
             
-            # Kill all old fceux processes
-            subprocess.run("ps -eo pid,lstart,comm | grep fceux | sort -k 4,4 -k 5,5M -k 6,6n -k 7,7n | head -n -8 | awk '{print $1}' | xargs kill -9", shell=True, capture_output=False)
-            time.sleep(0.5)
+            # The fceux processes of a job are killed with it (see nes_env.py), no need to clean them up here
             print(f"Launching {task} with tgrace {tgrace} seed {seed} in supermario tgrace exp ...")
             res_filepath = f"results/data/tgrace_different_values/supermario{task}_{tgrace}_{seed}.txt"
             cmd = f"exec python3 other_RL/super-mario-neat/src/main.py train --gen 10000 --task {task} --seed {seed} --method {method} --resultfilename {res_filepath} --gracetime {real_tgrace} --experiment_index_for_log {idx} --max_optimization_time {max_optimization_time}"
@@ -194,9 +194,7 @@ for task in tqdm(task_list):
             seed, method, task = experiment_parameters[idx]
             print(seed, method, task)
 
-            # Kill all old fceux processes
-            subprocess.run("ps -eo pid,lstart,comm | grep fceux | sort -k 4,4 -k 5,5M -k 6,6n -k 7,7n | head -n -8 | awk '{print $1}' | xargs kill -9", shell=True, capture_output=False)
-            time.sleep(0.5)
+            # The fceux processes of a job are killed with it (see nes_env.py), no need to clean them up here
             print(f"Launching {task} with seed {seed} in supermario tgrace exp ...")
             print(f"python3 other_RL/super-mario-neat/src/main.py train --gen {gens} --task {task} --seed {seed} --method {method} --resultfilename results/data/tgrace_experiment/supermario{task}_{seed}.txt --gracetime {gracetime} --experiment_index_for_log {idx}")
             subprocess.run(f"python3 other_RL/super-mario-neat/src/main.py train --gen {gens} --task {task} --seed {seed} --method {method} --resultfilename results/data/tgrace_experiment/supermario{task}_{seed}.txt --gracetime {gracetime} --experiment_index_for_log {idx} --max_optimization_time {max_optimization_time}",shell=True, capture_output=False)
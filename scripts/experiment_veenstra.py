@@ -1,6 +1,7 @@
 from argparse import ArgumentError
 
 from utils.UpdateParameter import *
+from utils.tgrace_calibration import load_calibrated_tgrace
 import subprocess
 import time
 import re
@@ -41,6 +42,8 @@ if sys.argv[1] == "--launch_local":
     import time
 
 
+    calibrated_gracetime, tolerance = load_calibrated_tgrace("veenstra", gracetime, 4800)
+
     def run_with_seed(seed):
 
         time.sleep(0.5)
@@ -48,7 +51,7 @@ if sys.argv[1] == "--launch_local":
         for method in method_list:
 
             res_filepath = os.getcwd() + "/" + f"results/data/veenstra/{method}_{seed}.txt"
-            bash_cmd = f"python3 other_RL/gym_rem2D/ModularER_2D/Demo2_Evolutionary_Run.py --method {method} --seed {seed} --gracetime {gracetime} --res_filepath {res_filepath}"
+            bash_cmd = f"python3 other_RL/gym_rem2D/ModularER_2D/Demo2_Evolutionary_Run.py --method {method} --seed {seed} --gracetime {calibrated_gracetime} --tolerance {tolerance} --res_filepath {res_filepath}"
             print(bash_cmd)
             exec_res=subprocess.run(bash_cmd,shell=True, capture_output=True)
         
@@ -0,0 +1,651 @@
+import os
+import time
+import fcntl
+import numpy as np
+from multiprocessing import shared_memory
+
+
+REFERENCE_MODES = ("asynchronous", "generation-synchronous")
+
+
+class GESPStopper:
+    """
+    Generalized early stopping for policy evaluation.
+
+    Keeps a preallocated reference curve (the objective value at each step of the best solution
+    found so far) and the curve of the episode currently being evaluated. The evaluation
+    is stopped at step t if
+
+        t >= t_grace  and  max(f[t], f[t - t_grace]) + tolerance < min(ref[t], ref[t - t_grace])
+
+    (tolerance is 0 by default, a positive margin makes stopping more conservative).
+
+    Usage in the evaluation loop of a runner:
+
+        stopper.reset()
+        for t in range(max_episode_length):
+            ...
+            if stopper.observe(t, f):
+                break
+        stopper.commit()
+
+    observe() only writes one value and compares four scalars, it never allocates arrays.
+
+    If a SharedGESPReference is given, the reference curve lives in shared memory and is
+    shared by all the processes that evaluate solutions.
+
+    reference_mode decides when a better episode becomes the reference:
+     - "asynchronous": as soon as it is committed. With a shared reference, episodes that are being
+       evaluated in other processes when the reference changes are re-checked against the new
+       reference over all their previous steps, and stopped if they are already dominated.
+     - "generation-synchronous": the best episode committed during a generation is staged, and only
+       becomes the reference when end_generation() is called.
+    """
+
+    def __init__(self, max_episode_length:int, t_grace:int, initial_value:float=-1e20, reference:'SharedGESPReference'=None, reference_mode:str="asynchronous", tolerance:float=0.0):
+        assert isinstance(max_episode_length, int) and max_episode_length > 0
+        assert isinstance(t_grace, int) and t_grace >= 0, f"t_grace = {t_grace} must be a non negative integer."
+        assert tolerance >= 0.0
+        assert reference_mode in REFERENCE_MODES, f"reference_mode = {reference_mode} must be one of {REFERENCE_MODES}."
+        self.max_episode_length = max_episode_length
+        self.t_grace = t_grace
+        self.initial_value = initial_value
+        self.tolerance = tolerance
+        self.reference = reference
+        self.reference_mode = reference_mode
+        self.is_synchronous = reference_mode == "generation-synchronous"
+        if reference is None:
+            self.ref = np.full(max_episode_length, initial_value, dtype=np.float64)
+            self._staged = np.full(max_episode_length, initial_value, dtype=np.float64) if self.is_synchronous else None
+            self._staged_f = None
+        else:
+            assert reference.max_episode_length == max_episode_length
+            self.ref = reference.ref
+        # Only a reference shared with other processes can change in the middle of an episode.
+        self._version = reference.counters if reference is not None and not self.is_synchronous else None
+        self._seen_version = 0
+        self.observed = np.full(max_episode_length, initial_value, dtype=np.float64)
+        self.n_commits = 0
+        self.n_rechecks = 0
+        self.reset()
+
+    def reset(self):
+        """Start the evaluation of a new episode."""
+        self.n_steps = 0
+        self.was_early_stopped = False
+        if self._version is not None:
+            self._seen_version = self._version[0]
+
+    def observe(self, t:int, f:float) -> bool:
+        """Register the objective value f at step t (0 indexed). Returns True if the evaluation should be stopped."""
+        observed = self.observed
+        observed[t] = f
+        self.n_steps = t + 1
+        if t < self.t_grace:
+            return False
+        if self._version is not None and self._version[0] != self._seen_version:
+            self._seen_version = self._version[0]
+            self.n_rechecks += 1
+            if self.is_dominated(t):
+                self.was_early_stopped = True
+                return True
+            return False
+        ref = self.ref
+        t_prev = t - self.t_grace
+        f_prev = observed[t_prev]
+        f_max = f if f > f_prev else f_prev
+        ref_now = ref[t]
+        ref_prev = ref[t_prev]
+        ref_min = ref_now if ref_now < ref_prev else ref_prev
+        if f_max + self.tolerance < ref_min:
+            self.was_early_stopped = True
+            return True
+        return False
+
+    def is_dominated(self, t:int, t_grace:int=None) -> bool:
+        """True if the stopping condition holds with the current reference at any step up to t."""
+        g = self.t_grace if t_grace is None else t_grace
+        if t < g:
+            return False
+        f_max = np.maximum(self.observed[g:t + 1], self.observed[:t + 1 - g])
+        ref_min = np.minimum(self.ref[g:t + 1], self.ref[:t + 1 - g])
+        return bool((f_max + self.tolerance < ref_min).any())
+
+    def last_value(self) -> float:
+        return self.observed[self.n_steps - 1] if self.n_steps > 0 else self.initial_value
+
+    def best_value(self) -> float:
+        """Final objective value of the reference solution."""
+        return self.ref[-1]
+
+    def commit(self, f:float=None, force:bool=False) -> bool:
+        """
+        Finish the evaluation of the current episode. The observed curve becomes the new reference
+        if the episode was not early stopped and its final objective value f (by default the last
+        observed value) is better than the final value of the reference. With force=True the
+        reference is replaced regardless. Returns True if the reference was updated (in
+        generation-synchronous mode it is never updated here, see end_generation()).
+        """
+        n = self.n_steps
+        if f is None:
+            f = self.last_value()
+        if n == 0 or (self.was_early_stopped and not force):
+            is_update = False
+        elif self.is_synchronous:
+            self._stage(n, f, force)
+            is_update = False
+        elif self.reference is None:
+            is_update = force or f > self.ref[-1]
+            if is_update:
+                self._update_ref(n)
+        else:
+            is_update = self.reference.publish(self.observed, n, f, force)
+        if is_update:
+            self.n_commits += 1
+        self.reset()
+        return is_update
+
+    def discard(self):
+        """Finish the evaluation of the current episode without considering it for the reference."""
+        self.reset()
+
+    def load_episode(self, observed:np.ndarray, was_early_stopped:bool=False):
+        """Make an episode observed elsewhere (e.g. by the stopper of a worker process) the current one, to commit() or discard() it."""
+        n = len(observed)
+        self.observed[:n] = observed
+        self.n_steps = n
+        self.was_early_stopped = was_early_stopped
+
+    def _update_ref(self, n:int):
+        self.ref[:n] = self.observed[:n]
+        self.ref[n:] = self.observed[n - 1]
+
+    def _stage(self, n:int, f:float, force:bool):
+        if self.reference is not None:
+            self.reference.stage(self.observed, n, f, force)
+        elif (force or f > self.ref[-1]) and (self._staged_f is None or f > self._staged_f):
+            self._staged[:n] = self.observed[:n]
+            self._staged[n:] = self.observed[n - 1]
+            self._staged_f = f
+
+    def end_generation(self) -> bool:
+        """
+        In generation-synchronous mode, the best episode committed since the last call becomes the
+        reference. Returns True if the reference was updated. Does nothing in asynchronous mode.
+        """
+        if not self.is_synchronous:
+            return False
+        if self.reference is not None:
+            is_update = self.reference.publish_staged()
+        else:
+            is_update = self._staged_f is not None
+            if is_update:
+                self.ref[:] = self._staged
+                self._staged_f = None
+        if is_update:
+            self.n_commits += 1
+        return is_update
+
+
+
+class AdaptiveGESPStopper(GESPStopper):
+    """
+    GESPStopper that retunes t_grace during the run.
+
+    A random fraction (audit_fraction) of the episodes are audit episodes, which are never stopped.
+    When an audit episode is committed, it is checked whether the current t_grace would have
+    stopped it:
+     - if it would have been stopped but it improves the reference, t_grace is widened (x widen_factor).
+     - if patience audit episodes in a row would have been stopped without improving the reference,
+       t_grace is shrunk (x shrink_factor). An audit episode that would not have been stopped breaks
+       the streak.
+    t_grace stays in [t_grace_min, t_grace_max] (by default [1, max_episode_length]).
+    """
+
+    def __init__(self, max_episode_length:int, t_grace:int, initial_value:float=-1e20, reference:'SharedGESPReference'=None, reference_mode:str="asynchronous", tolerance:float=0.0,
+                 audit_fraction:float=0.05, widen_factor:float=2.0, shrink_factor:float=0.8, patience:int=20, t_grace_min:int=1, t_grace_max:int=None, seed:int=None):
+        assert 0.0 < audit_fraction <= 1.0
+        assert widen_factor > 1.0 and 0.0 < shrink_factor < 1.0
+        self.audit_fraction = audit_fraction
+        self.widen_factor = widen_factor
+        self.shrink_factor = shrink_factor
+        self.patience = patience
+        self.t_grace_min = t_grace_min
+        self.t_grace_max = max_episode_length if t_grace_max is None else t_grace_max
+        self.rng = np.random.default_rng(seed)
+        self.is_audit = False
+        self.n_audits = 0
+        self.n_audit_misses = 0
+        self._n_audits_stopped_no_miss = 0
+        super().__init__(max_episode_length, t_grace, initial_value, reference, reference_mode, tolerance)
+
+    def reset(self):
+        super().reset()
+        self.is_audit = self.rng.random() < self.audit_fraction
+
+    def observe(self, t:int, f:float) -> bool:
+        if self.is_audit:
+            self.observed[t] = f
+            self.n_steps = t + 1
+            return False
+        return super().observe(t, f)
+
+    def commit(self, f:float=None, force:bool=False) -> bool:
+        if self.is_audit and self.n_steps > 0:
+            self._audit(self.last_value() if f is None else f, force)
+        return super().commit(f, force)
+
+    def discard(self):
+        if self.is_audit and self.n_steps > 0:
+            self._audit(None, False)
+        super().discard()
+
+    def _audit(self, f:float, force:bool):
+        """f = None means that the episode does not improve the reference."""
+        self.n_audits += 1
+        if not self.is_dominated(self.n_steps - 1):
+            self._n_audits_stopped_no_miss = 0
+            return
+        if force or (f is not None and f > self.ref[-1]):
+            self.n_audit_misses += 1
+            self._n_audits_stopped_no_miss = 0
+            self.t_grace = min(self.t_grace_max, max(self.t_grace + 1, round(self.t_grace * self.widen_factor)))
+        else:
+            self._n_audits_stopped_no_miss += 1
+            if self._n_audits_stopped_no_miss >= self.patience:
+                self._n_audits_stopped_no_miss = 0
+                self.t_grace = max(self.t_grace_min, round(self.t_grace * self.shrink_factor))
+
+
+
+class TimeGESPStopper:
+    """
+    GESP with the curves indexed by elapsed time (wall-clock or simulated seconds) instead of steps,
+    for environments in which the cost of a step is not constant. The grace period t_grace is given
+    in seconds, and the evaluation is stopped at time s if
+
+        s >= t_grace  and  max(f(s), f(s - t_grace)) + tolerance < min(ref(s), ref(s - t_grace))
+
+    The curves are sampled at irregular times, so f and ref are linearly interpolated (ref is
+    constant after its last sample). As in GESPStopper the arrays are preallocated (max_samples
+    observations per episode), and the times queried in an episode only increase, so the
+    interpolation keeps a pointer in each curve instead of searching.
+
+        stopper.reset()
+        while ...:
+            if stopper.observe(elapsed_seconds, f):
+                break
+        stopper.commit()
+    """
+
+    def __init__(self, max_samples:int, t_grace:float, initial_value:float=-1e20, tolerance:float=0.0):
+        assert isinstance(max_samples, int) and max_samples > 0
+        assert t_grace >= 0.0, f"t_grace = {t_grace} must be non negative."
+        self.max_samples = max_samples
+        self.t_grace = t_grace
+        self.initial_value = initial_value
+        self.tolerance = tolerance
+        self.observed_time = np.zeros(max_samples, dtype=np.float64)
+        self.observed = np.full(max_samples, initial_value, dtype=np.float64)
+        self.ref_time = np.zeros(max_samples, dtype=np.float64)
+        self.ref = np.full(max_samples, initial_value, dtype=np.float64)
+        self.ref_n = 0
+        self.n_commits = 0
+        self.reset()
+
+    def reset(self):
+        """Start the evaluation of a new episode."""
+        self.n_steps = 0
+        self.was_early_stopped = False
+        self._ptr_ref_now = 0
+        self._ptr_ref_prev = 0
+        self._ptr_prev = 0
+
+    @staticmethod
+    def _value_at(times:np.ndarray, values:np.ndarray, n:int, s:float, k:int):
+        """Value of the curve at time s, and the new pointer k (times[k] <= s) to continue from."""
+        while k + 1 < n and times[k + 1] <= s:
+            k += 1
+        if s <= times[0] or k + 1 >= n:
+            return (values[0] if s <= times[0] else values[n - 1]), k
+        t0 = times[k]
+        return values[k] + (values[k + 1] - values[k]) * (s - t0) / (times[k + 1] - t0), k
+
+    def observe(self, s:float, f:float) -> bool:
+        """Register the objective value f at elapsed time s. Returns True if the evaluation should be stopped."""
+        n = self.n_steps
+        assert n < self.max_samples, f"More than max_samples = {self.max_samples} observations in an episode."
+        self.observed_time[n] = s
+        self.observed[n] = f
+        self.n_steps = n + 1
+        if s < self.t_grace or self.ref_n == 0:
+            return False
+        s_prev = s - self.t_grace
+        f_prev, self._ptr_prev = self._value_at(self.observed_time, self.observed, n + 1, s_prev, self._ptr_prev)
+        ref_now, self._ptr_ref_now = self._value_at(self.ref_time, self.ref, self.ref_n, s, self._ptr_ref_now)
+        ref_prev, self._ptr_ref_prev = self._value_at(self.ref_time, self.ref, self.ref_n, s_prev, self._ptr_ref_prev)
+        f_max = f if f > f_prev else f_prev
+        ref_min = ref_now if ref_now < ref_prev else ref_prev
+        if f_max + self.tolerance < ref_min:
+            self.was_early_stopped = True
+            return True
+        return False
+
+    def last_value(self) -> float:
+        return self.observed[self.n_steps - 1] if self.n_steps > 0 else self.initial_value
+
+    def best_value(self) -> float:
+        """Final objective value of the reference solution."""
+        return self.ref[self.ref_n - 1] if self.ref_n > 0 else self.initial_value
+
+    def commit(self, f:float=None, force:bool=False) -> bool:
+        """Same as GESPStopper.commit()."""
+        n = self.n_steps
+        if f is None:
+            f = self.last_value()
+        is_update = n > 0 and (force or (not self.was_early_stopped and f > self.best_value()))
+        if is_update:
+            self.ref_time[:n] = self.observed_time[:n]
+            self.ref[:n] = self.observed[:n]
+            self.ref_n = n
+            self.n_commits += 1
+        self.reset()
+        return is_update
+
+    def discard(self):
+        self.reset()
+
+    def end_generation(self) -> bool:
+        return False
+
+
+
+class SharedGESPReference:
+    """
+    GESP reference curve in a multiprocessing.shared_memory buffer, so that evaluations running in
+    several processes read the latest reference without pickling it.
+
+    Besides the curve, the buffer holds a version number (increased on every update), the curve
+    staged in generation-synchronous mode, and the total number of evaluated episodes and steps,
+    with the runtime of the last n_episode_slots episodes.
+    Updates go through a file lock (fcntl), so any process that unpickles the object can write to it.
+    Reads are not locked: a reader can see a curve that is being replaced, which only affects the
+    stopping decision of a single step.
+
+    The process that creates the buffer must call unlink() when the experiment is over. The object
+    is meant to be used by the processes started from that one (which share its resource tracker).
+    """
+
+    _N_COUNTERS = 4 # version, total steps, total episodes, is there a staged curve
+
+    def __init__(self, max_episode_length:int, initial_value:float=-1e20, n_episode_slots:int=1, name:str=None):
+        assert isinstance(max_episode_length, int) and max_episode_length > 0
+        self.max_episode_length = max_episode_length
+        self.initial_value = initial_value
+        self.n_episode_slots = n_episode_slots
+        is_create = name is None
+        size = 8 * (self._N_COUNTERS + 2 * max_episode_length + 1 + n_episode_slots)
+        self.shm = shared_memory.SharedMemory(name=name, create=is_create, size=size)
+        self.name = self.shm.name
+        T = max_episode_length
+        self.counters = np.ndarray((self._N_COUNTERS,), dtype=np.int64, buffer=self.shm.buf, offset=0)
+        self.ref = np.ndarray((T,), dtype=np.float64, buffer=self.shm.buf, offset=8 * self._N_COUNTERS)
+        self.staged = np.ndarray((T,), dtype=np.float64, buffer=self.shm.buf, offset=8 * (self._N_COUNTERS + T))
+        self.staged_f = np.ndarray((1,), dtype=np.float64, buffer=self.shm.buf, offset=8 * (self._N_COUNTERS + 2 * T))
+        self.episode_runtimes = np.ndarray((n_episode_slots,), dtype=np.float64, buffer=self.shm.buf, offset=8 * (self._N_COUNTERS + 2 * T + 1))
+        self._lock_path = os.path.join("/tmp", self.name.lstrip("/") + ".lock")
+        self._lock_fd = None
+        self._lock_pid = None
+        if is_create:
+            self.counters[:] = 0
+            self.ref[:] = initial_value
+            self.staged[:] = initial_value
+            self.staged_f[:] = initial_value
+            self.episode_runtimes[:] = 0.0
+
+    def __getstate__(self):
+        return (self.max_episode_length, self.initial_value, self.n_episode_slots, self.name)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def _lock(self):
+        # flock locks are shared by forked processes with the same file descriptor, so each process opens its own.
+        if self._lock_pid != os.getpid():
+            self._lock_fd = os.open(self._lock_path, os.O_CREAT | os.O_RDWR)
+            self._lock_pid = os.getpid()
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    @property
+    def version(self) -> int:
+        return int(self.counters[0])
+
+    @property
+    def total_steps(self) -> int:
+        return int(self.counters[1])
+
+    @property
+    def n_episodes(self) -> int:
+        return int(self.counters[2])
+
+    def publish(self, observed:np.ndarray, n:int, f:float, force:bool=False) -> bool:
+        """Replace the reference with observed[:n] if f is better than its final value (or force=True)."""
+        self._lock()
+        try:
+            is_update = force or f > self.ref[-1]
+            if is_update:
+                self.ref[:n] = observed[:n]
+                self.ref[n:] = observed[n - 1]
+                self.counters[0] += 1
+        finally:
+            self._unlock()
+        return is_update
+
+    def stage(self, observed:np.ndarray, n:int, f:float, force:bool=False) -> bool:
+        """Keep observed[:n] to be published by publish_staged() if it is the best candidate of the generation."""
+        self._lock()
+        try:
+            is_staged = (force or f > self.ref[-1]) and (self.counters[3] == 0 or f > self.staged_f[0])
+            if is_staged:
+                self.staged[:n] = observed[:n]
+                self.staged[n:] = observed[n - 1]
+                self.staged_f[0] = f
+                self.counters[3] = 1
+        finally:
+            self._unlock()
+        return is_staged
+
+    def publish_staged(self) -> bool:
+        """Replace the reference with the staged curve, if there is one."""
+        self._lock()
+        try:
+            is_update = self.counters[3] == 1
+            if is_update:
+                self.ref[:] = self.staged
+                self.counters[3] = 0
+                self.counters[0] += 1
+        finally:
+            self._unlock()
+        return bool(is_update)
+
+    def record_episode(self, n_steps:int, runtime:float=0.0) -> int:
+        """Add an evaluated episode to the counters. Returns its index among all the episodes evaluated."""
+        self._lock()
+        try:
+            episode_index = int(self.counters[2])
+            self.counters[1] += n_steps
+            self.counters[2] += 1
+            self.episode_runtimes[episode_index % self.n_episode_slots] = runtime
+        finally:
+            self._unlock()
+        return episode_index
+
+    def close(self):
+        self.counters = self.ref = self.staged = self.staged_f = self.episode_runtimes = None
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
+        if os.path.exists(self._lock_path):
+            os.remove(self._lock_path)
+
+
+
+class BatchGESPStopper:
+    """
+    GESP for N candidates evaluated in lockstep (e.g. a CMA-ES population stepped as a batch).
+
+    The cumulative rewards are stored in a preallocated (N, T) array. At each step observe() writes
+    the values of the lanes that are still running and checks the stopping rule for all of them with
+    one vectorized comparison against the reference. Lanes that have finished (either early stopped
+    or terminated by the environment with finish()) are no longer touched.
+
+        stopper.reset()
+        for t in range(max_episode_length):
+            f = ...                       # (N,) cumulative rewards at step t
+            retire = stopper.observe(t, f)
+            ...                           # stop stepping the lanes in retire
+            if not stopper.any_active():
+                break
+        stopper.commit()
+
+    The reference array can be shared with a GESPStopper through the ref argument, and tolerance is
+    the same margin as in GESPStopper.
+    """
+
+    def __init__(self, n_lanes:int, max_episode_length:int, t_grace:int, initial_value:float=-1e20, ref:np.ndarray=None, tolerance:float=0.0):
+        assert isinstance(n_lanes, int) and n_lanes > 0
+        assert isinstance(max_episode_length, int) and max_episode_length > 0
+        assert isinstance(t_grace, int) and t_grace >= 0, f"t_grace = {t_grace} must be a non negative integer."
+        assert tolerance >= 0.0
+        self.n_lanes = n_lanes
+        self.max_episode_length = max_episode_length
+        self.t_grace = t_grace
+        self.initial_value = initial_value
+        self.tolerance = tolerance
+        if ref is None:
+            ref = np.full(max_episode_length, initial_value, dtype=np.float64)
+        assert ref.shape == (max_episode_length,)
+        self.ref = ref
+        self.observed = np.full((n_lanes, max_episode_length), initial_value, dtype=np.float64)
+        self.n_steps = np.zeros(n_lanes, dtype=np.int64)
+        self.was_early_stopped = np.zeros(n_lanes, dtype=bool)
+        self.is_active = np.zeros(n_lanes, dtype=bool)
+        self._retire_mask = np.zeros(n_lanes, dtype=bool)
+        self.n_commits = 0
+        self.reset()
+
+    def reset(self):
+        """Start the evaluation of a new batch of N episodes."""
+        self.n_steps[:] = 0
+        self.was_early_stopped[:] = False
+        self.is_active[:] = True
+        self._active_idx = np.arange(self.n_lanes)
+
+    def any_active(self) -> bool:
+        return len(self._active_idx) > 0
+
+    def active_lanes(self) -> np.ndarray:
+        return self._active_idx
+
+    def observe(self, t:int, f:np.ndarray) -> np.ndarray:
+        """
+        Register the objective values f (shape (N,), values of finished lanes are ignored) at step t.
+        Returns a boolean mask of shape (N,) with the lanes that must be retired at this step.
+        The returned array is reused in the next call.
+        """
+        retire = self._retire_mask
+        retire[:] = False
+        idx = self._active_idx
+        if len(idx) == 0:
+            return retire
+        f_active = f[idx]
+        self.observed[idx, t] = f_active
+        self.n_steps[idx] = t + 1
+        if t < self.t_grace:
+            return retire
+        t_prev = t - self.t_grace
+        ref_min = min(self.ref[t], self.ref[t_prev])
+        is_stop = np.maximum(f_active, self.observed[idx, t_prev]) + self.tolerance < ref_min
+        if is_stop.any():
+            stopped_idx = idx[is_stop]
+            retire[stopped_idx] = True
+            self.was_early_stopped[stopped_idx] = True
+            self.is_active[stopped_idx] = False
+            self._active_idx = idx[~is_stop]
+        return retire
+
+    def finish(self, lanes):
+        """Mark lanes (boolean mask or indices) as terminated by the environment, without early stopping."""
+        self.is_active[lanes] = False
+        self._active_idx = np.flatnonzero(self.is_active)
+
+    def final_values(self) -> np.ndarray:
+        return self.observed[np.arange(self.n_lanes), np.maximum(self.n_steps - 1, 0)]
+
+    def commit(self, f:np.ndarray=None) -> int:
+        """
+        Finish the evaluation of the batch. The best lane that was not early stopped becomes the
+        reference if its final objective value (f, by default the last observed values) is better
+        than the final value of the reference. Returns the index of that lane, or -1 if the
+        reference was not updated.
+        """
+        if f is None:
+            f = self.final_values()
+        candidates = np.flatnonzero(~self.was_early_stopped & (self.n_steps > 0))
+        best_lane = -1
+        if len(candidates) > 0:
+            lane = candidates[np.argmax(f[candidates])]
+            if f[lane] > self.ref[-1]:
+                n = self.n_steps[lane]
+                self.ref[:n] = self.observed[lane, :n]
+                self.ref[n:] = self.observed[lane, n - 1]
+                self.n_commits += 1
+                best_lane = int(lane)
+        self.reset()
+        return best_lane
+
+
+
+def benchmark_observe(max_episode_length:int=1000, t_grace:int=200, n_episodes:int=200, seed:int=2):
+    """Time per observe() call on random monotone curves, to compare the overhead of GESP across frameworks."""
+    rs = np.random.RandomState(seed)
+    curves = np.cumsum(rs.rand(n_episodes, max_episode_length), axis=1).tolist()
+    stopper = GESPStopper(max_episode_length, t_grace)
+    n_calls = 0
+    ref_t = time.perf_counter()
+    for curve in curves:
+        stopper.reset()
+        for t, f in enumerate(curve):
+            n_calls += 1
+            if stopper.observe(t, f):
+                break
+        stopper.commit()
+    return (time.perf_counter() - ref_t) / n_calls
+
+
+def benchmark_batch_observe(n_lanes:int=100, max_episode_length:int=1000, t_grace:int=200, n_batches:int=20, seed:int=2):
+    """Time per lane-step of BatchGESPStopper.observe() on random monotone curves."""
+    rs = np.random.RandomState(seed)
+    curves = np.cumsum(rs.rand(n_batches, n_lanes, max_episode_length), axis=2)
+    stopper = BatchGESPStopper(n_lanes, max_episode_length, t_grace)
+    n_lane_steps = 0
+    ref_t = time.perf_counter()
+    for batch in curves:
+        stopper.reset()
+        for t in range(max_episode_length):
+            n_lane_steps += len(stopper.active_lanes())
+            stopper.observe(t, batch[:, t])
+            if not stopper.any_active():
+                break
+        stopper.commit()
+    return (time.perf_counter() - ref_t) / n_lane_steps
+
+
+if __name__ == "__main__":
+    print(f"GESPStopper.observe(): {benchmark_observe() * 1e9:.1f} ns per call.")
+    print(f"BatchGESPStopper.observe(): {benchmark_batch_observe() * 1e9:.1f} ns per lane and step.")
@@ -0,0 +1,99 @@
+import gym
+import numpy as np
+from gym.utils.step_api_compatibility import step_api_compatibility
+from gesp import GESPStopper
+
+
+
+class GESPTruncationWrapper(gym.Wrapper):
+    """
+    Truncates the episodes of any gym environment with GESP, using the cumulative reward as the objective value.
+
+    When the stopping condition fires, the step is returned as truncated (done with the old step API) and
+    info["gesp_truncated"] is set. At the end of an episode that was not early stopped, the cumulative
+    reward curve becomes the new reference if it is better than the current one, in which case a copy of
+    it is returned in info["gesp_reference"] so that it can be broadcast to other copies of the environment
+    (see GESPReferenceBroadcaster).
+    """
+
+    def __init__(self, env:gym.Env, t_grace:int, max_episode_length:int=None, new_step_api:bool=False):
+        super().__init__(env, new_step_api)
+        if max_episode_length is None:
+            assert env.spec is not None and env.spec.max_episode_steps is not None, "max_episode_length is required for environments without a time limit."
+            max_episode_length = env.spec.max_episode_steps
+        self.stopper = GESPStopper(max_episode_length, t_grace)
+        self._t = 0
+        self._cumulative_reward = 0.0
+
+    def reset(self, **kwargs):
+        self.stopper.reset()
+        self._t = 0
+        self._cumulative_reward = 0.0
+        return self.env.reset(**kwargs)
+
+    def step(self, action):
+        observation, reward, terminated, truncated, info = step_api_compatibility(self.env.step(action), True)
+        self._cumulative_reward += reward
+        t = self._t
+        self._t += 1
+        if t < self.stopper.max_episode_length and self.stopper.observe(t, self._cumulative_reward):
+            truncated = True
+            info["gesp_truncated"] = True
+        if terminated or truncated:
+            info["gesp_episode_return"] = self._cumulative_reward
+            if self.stopper.commit(self._cumulative_reward):
+                info["gesp_reference"] = self.stopper.ref.copy()
+        return step_api_compatibility((observation, reward, terminated, truncated, info), self.new_step_api)
+
+    def set_reference(self, ref:np.ndarray):
+        """Replace the reference curve (called in each subprocess by GESPReferenceBroadcaster)."""
+        self.stopper.ref[:] = ref
+
+    def get_reference(self) -> np.ndarray:
+        return self.stopper.ref
+
+
+
+def make_gesp_async_vector_env(env_fns, t_grace:int, max_episode_length:int=None, new_step_api:bool=False, **kwargs) -> gym.vector.AsyncVectorEnv:
+    """AsyncVectorEnv in which each copy of the environment runs in a subprocess wrapped in a GESPTruncationWrapper."""
+
+    def _wrap(env_fn):
+        return lambda: GESPTruncationWrapper(env_fn(), t_grace, max_episode_length, new_step_api=True)
+
+    return gym.vector.AsyncVectorEnv([_wrap(env_fn) for env_fn in env_fns], new_step_api=new_step_api, **kwargs)
+
+
+
+class GESPReferenceBroadcaster:
+    """
+    Keeps the environments of a vector env (created with make_gesp_async_vector_env) on the same reference.
+
+    Call update(infos) after each vector step: if one of the copies found a better reference curve, it is
+    sent to all the subprocesses.
+    """
+
+    def __init__(self, vector_env:gym.vector.VectorEnv):
+        self.vector_env = vector_env
+        self.ref = None
+        self.n_broadcasts = 0
+
+    def _candidate_references(self, infos):
+        if isinstance(infos, dict):
+            if "gesp_reference" not in infos:
+                return []
+            return [ref for ref, is_set in zip(infos["gesp_reference"], infos["_gesp_reference"]) if is_set]
+        else:
+            return [info["gesp_reference"] for info in infos if "gesp_reference" in info]
+
+    def update(self, infos) -> bool:
+        """Returns True if a new reference was broadcast."""
+        candidates = self._candidate_references(infos)
+        if len(candidates) == 0:
+            return False
+        best = max(candidates, key=lambda ref: ref[-1])
+        if self.ref is not None and not best[-1] > self.ref[-1]:
+            return False
+        self.ref = best
+        self.vector_env.call("set_reference", best)
+        self.n_broadcasts += 1
+        return True
@@ -0,0 +1,249 @@
+import numpy as np
+from joblib import Parallel, delayed
+
+
+
+def pack_curves(f_rows:np.ndarray):
+    """
+    Pack the NaN padded objective value curves of one seed (one row per episode) for replay_tgrace_sweep().
+    The curves are stored as float32 when that does not change any value (otherwise as float64),
+    together with the number of non NaN values in each curve.
+    """
+    f_rows = np.asarray(f_rows, dtype=np.float64)
+    lengths = f_rows.shape[1] - np.isnan(f_rows).sum(axis=1)
+    f_rows_32 = f_rows.astype(np.float32)
+    if np.array_equal(f_rows_32.astype(np.float64), f_rows, equal_nan=True) and np.float32(-1e10) == -1e10:
+        f_rows = f_rows_32
+    return f_rows, lengths
+
+
+
+def _reference_index(f_rows:np.ndarray, f_rows_no_nans:np.ndarray, is_monotone_increasing:bool):
+    """
+    Index of the episode whose curve is the reference when each episode is evaluated, and whether
+    each episode improves the reference. The reference does not depend on t_grace.
+    """
+    n_episodes = f_rows.shape[0]
+    ref_index = np.zeros(n_episodes, dtype=np.int64)
+    is_better = np.zeros(n_episodes, dtype=bool)
+    score = f_rows_no_nans.max(axis=1) if is_monotone_increasing else f_rows_no_nans[:, -1]
+    current = 0
+    for e in range(n_episodes):
+        ref_index[e] = current
+        if score[e] > score[current]:
+            is_better[e] = True
+            current = e
+    return ref_index, is_better
+
+
+
+def _running_best(values:np.ndarray):
+    """Same as folding the builtin max() along axis 0 (a NaN in the first position is kept)."""
+    res = np.fmax.accumulate(values, axis=0)
+    res[:, np.isnan(values[0])] = np.nan
+    return res
+
+
+
+def _stop_lengths(f_rows, f_rows_no_nans, ref_index, lengths, grace_steps, tolerance=0.0, max_chunk_elements=2**25):
+    """Episode length with GESP for every episode (rows) and grace period (columns)."""
+    n_episodes, max_episode_length = f_rows.shape
+    k = np.arange(max_episode_length)
+    shifted = k[None, :] + grace_steps[:, None]
+    is_valid = shifted < max_episode_length
+    shifted = np.minimum(shifted, max_episode_length - 1)
+
+    res = np.empty((n_episodes, len(grace_steps)), dtype=np.int64)
+    chunk = max(1, max_chunk_elements // (len(grace_steps) * max_episode_length))
+    for start in range(0, n_episodes, chunk):
+        f = f_rows[start:start + chunk]
+        ref = f_rows_no_nans[ref_index[start:start + chunk]]
+        f_max = np.maximum(f[:, None, :], f[:, shifted])
+        ref_min = np.minimum(ref[:, None, :], ref[:, shifted])
+        if tolerance != 0.0:
+            f_max += tolerance
+        is_stop = (f_max < ref_min) & is_valid
+        first = is_stop.argmax(axis=2)
+        res[start:start + chunk] = np.where(is_stop.any(axis=2), first + 1 + grace_steps[None, :], lengths[start:start + chunk, None])
+    return res
+
+
+
+def replay_tgrace_sweep(f_rows:np.ndarray, lengths:np.ndarray, grace_steps:np.ndarray, is_monotone_increasing:bool, tolerance:float=0.0):
+    """
+    Replay GESP on the curves of one seed (see pack_curves) for all the grace periods in grace_steps at once.
+
+    Returns a dict with one value per grace period:
+     - "best_solution_not_missed": proportion of the improvements of the reference that are not early stopped.
+     - "frames_evaluated": steps computed with GESP / steps computed without GESP.
+     - "gesp_eq_or_better": 1.0 if the best objective value with GESP is at least as good as the one
+        found without GESP with the same number of steps.
+    The values are identical to the ones of tgrace_exp_figures.when2stopGESP() episode by episode
+    (with tolerance = 0, see GESPStopper for the tolerance margin).
+    """
+    grace_steps = np.asarray(grace_steps, dtype=np.int64)
+    n_episodes, max_episode_length = f_rows.shape
+    assert is_monotone_increasing or np.all(lengths == max_episode_length), "The environment needs to have either \n1) a monotone increasing f \nor\n2) A constant episode length."
+
+    f_rows_no_nans = np.where(np.isnan(f_rows), f_rows.dtype.type(-1e10), f_rows)
+    ref_index, is_better = _reference_index(f_rows, f_rows_no_nans, is_monotone_increasing)
+    if not is_better.any():
+        raise ValueError("res[\"is_better_than_best_found_wo_gesp\"] was always false")
+
+    lengths_w_gesp = _stop_lengths(f_rows, f_rows_no_nans, ref_index, lengths, grace_steps, tolerance)
+    was_early_stopped = lengths_w_gesp < lengths[:, None]
+    rows = np.arange(n_episodes)[:, None]
+
+    best_solution_not_missed = np.mean(~was_early_stopped[is_better], axis=0)
+    frames_evaluated = lengths_w_gesp.sum(axis=0) / lengths.sum()
+
+    # Best f with GESP at the end vs best f without GESP after the same number of steps.
+    f_w_gesp = f_rows[rows, lengths_w_gesp - 1].astype(np.float64)
+    best_f_w_gesp = _running_best(f_w_gesp)[-1]
+    best_f_wo_gesp = _running_best(f_rows[np.arange(n_episodes), lengths - 1].astype(np.float64)[:, None])[:, 0]
+    steps_wo_gesp = np.cumsum(lengths)
+    idx = np.searchsorted(steps_wo_gesp, lengths_w_gesp.sum(axis=0), side="right") - 1
+    assert np.all(idx >= 0)
+    gesp_eq_or_better = np.where(best_f_w_gesp >= best_f_wo_gesp[idx], 1.0, 0.0)
+
+    return {
+        "best_solution_not_missed": best_solution_not_missed,
+        "frames_evaluated": frames_evaluated,
+        "gesp_eq_or_better": gesp_eq_or_better,
+    }
+
+
+
+def replay_tgrace_sweep_seeds(f_rows_per_seed, grace_steps:np.ndarray, is_monotone_increasing:bool, n_jobs:int=-1, tolerance:float=0.0):
+    """replay_tgrace_sweep() for a list of seeds, in parallel. Returns a list with the result of each seed."""
+    return Parallel(n_jobs=n_jobs)(delayed(replay_tgrace_sweep)(*pack_curves(f_rows), grace_steps, is_monotone_increasing, tolerance) for f_rows in f_rows_per_seed)
+
+
+
+# Stopping policies for replay_policies(). A policy gets a chunk of curves f (episodes x T, NaN after
+# the end of each episode) and the reference curve that each episode is compared with (same shape),
+# and returns a boolean array that is True at the steps after which the evaluation is stopped.
+
+def natural_termination_policy():
+    """Episodes are only stopped by the environment."""
+    return lambda f, ref: np.zeros(f.shape, dtype=bool)
+
+
+def gesp_policy(t_grace:int, tolerance:float=0.0):
+    def policy(f, ref):
+        is_stop = np.zeros(f.shape, dtype=bool)
+        g = t_grace
+        if g < f.shape[1]:
+            is_stop[:, g:] = np.maximum(f[:, g:], f[:, :f.shape[1] - g]) + tolerance < np.minimum(ref[:, g:], ref[:, :f.shape[1] - g])
+        return is_stop
+    return policy
+
+
+def constant_policy(window:int=50, initial_value:float=0.0):
+    """Mario's constant method: stop if f did not change in the last window steps (checked every window steps)."""
+    def policy(f, ref):
+        is_stop = np.zeros(f.shape, dtype=bool)
+        checks = np.arange(window - 1, f.shape[1], window)
+        previous = np.concatenate((np.full((f.shape[0], 1), initial_value, dtype=f.dtype), f[:, checks[:-1]]), axis=1)
+        is_stop[:, checks] = f[:, checks] == previous
+        return is_stop
+    return policy
+
+
+def wall_of_death_policy(speed:float=0.04, logevery:int=1):
+    """REM2D's wall of death (the problemspecific method): stop when the wall, moving speed per step, passes f."""
+    def policy(f, ref):
+        wall_position = speed * (np.arange(f.shape[1]) * logevery + 1)
+        return f < wall_position[None, :]
+    return policy
+
+
+def fixed_length_policy(n_steps:int):
+    """Evaluate every episode for at most n_steps (e.g. ARE's constant evaluation time)."""
+    def policy(f, ref):
+        is_stop = np.zeros(f.shape, dtype=bool)
+        if n_steps <= f.shape[1]:
+            is_stop[:, n_steps - 1] = True
+        return is_stop
+    return policy
+
+
+
+def replay_policies(f_rows:np.ndarray, lengths:np.ndarray, policies:dict, is_monotone_increasing:bool, max_chunk_elements:int=2**24):
+    """
+    Replay the stopping policies (name -> policy) on the full length curves of one seed (see pack_curves).
+
+    As in replay_tgrace_sweep(), the reference of each episode is the best curve logged before it,
+    whether or not the policy would have stopped that episode. Returns, for each policy, a dict with:
+     - "frames_computed": total number of steps computed.
+     - "frames_evaluated": frames_computed / steps computed without stopping.
+     - "solutions_missed": proportion of the improvements of the reference that are stopped.
+     - "anytime_steps", "anytime_best_f": the best objective value found after each episode, and the
+        number of steps computed at that point.
+    """
+    n_episodes, max_episode_length = f_rows.shape
+    f_rows_no_nans = np.where(np.isnan(f_rows), f_rows.dtype.type(-1e10), f_rows)
+    ref_index, is_better = _reference_index(f_rows, f_rows_no_nans, is_monotone_increasing)
+    chunk = max(1, max_chunk_elements // max_episode_length)
+
+    res = {}
+    for name, policy in policies.items():
+        lengths_w_policy = np.empty(n_episodes, dtype=np.int64)
+        for start in range(0, n_episodes, chunk):
+            is_stop = policy(f_rows[start:start + chunk], f_rows_no_nans[ref_index[start:start + chunk]])
+            first = np.where(is_stop.any(axis=1), is_stop.argmax(axis=1) + 1, max_episode_length)
+            lengths_w_policy[start:start + chunk] = np.minimum(first, lengths[start:start + chunk])
+        was_stopped = lengths_w_policy < lengths
+        f_final = f_rows_no_nans[np.arange(n_episodes), np.maximum(lengths_w_policy, 1) - 1].astype(np.float64)
+        res[name] = {
+            "frames_computed": int(lengths_w_policy.sum()),
+            "frames_evaluated": lengths_w_policy.sum() / lengths.sum(),
+            "solutions_missed": np.mean(was_stopped[is_better]) if is_better.any() else 0.0,
+            "anytime_steps": np.cumsum(lengths_w_policy),
+            "anytime_best_f": np.maximum.accumulate(f_final),
+        }
+    return res
+
+
+
+def replay_policies_seeds(f_rows_per_seed, policies:dict, is_monotone_increasing:bool, n_jobs:int=-1):
+    """replay_policies() for a list of seeds, in parallel. Returns a list with the result of each seed."""
+    return Parallel(n_jobs=n_jobs)(delayed(replay_policies)(*pack_curves(f_rows), policies, is_monotone_increasing) for f_rows in f_rows_per_seed)
+
+
+
+def load_nokill_log(file_path:str):
+    """Read the curves logged by TgraceNokillLogger (one row per episode: time, f_0, f_1...) as a NaN padded array."""
+    import csv
+    with open(file_path, "r") as f:
+        rows = [[float(v) for v in row[1:]] for row in csv.reader(f)]
+    f_rows = np.full((len(rows), max(len(row) for row in rows)), np.nan)
+    for i, row in enumerate(rows):
+        f_rows[i, :len(row)] = row
+    return f_rows
+
+
+
+if __name__ == "__main__":
+    import argparse
+    from src_tgrace_experiment import tgrace_exp_figures
+
+    parser = argparse.ArgumentParser(description='Estimate the steps saved by stopping policies from the logs of the tgrace experiment.')
+    parser.add_argument('--experiment_name', required=True, type=str, help='Prefix of the log files, e.g. garagegymCartPole-v1.')
+    parser.add_argument('--path', type=str, default="results/data/tgrace_experiment/", help='Directory with the logs.')
+    parser.add_argument('--t_grace', type=float, default=0.2, help='Grace period of GESP, as a proportion of the episode length.')
+    parser.add_argument('--monotone', action='store_true', help='The objective value is monotone increasing (any episode length is allowed).')
+    args = parser.parse_args()
+
+    f_rows_per_seed = [load_nokill_log(path) for path in tgrace_exp_figures._get_filepath_list(args.experiment_name, args.path)]
+    max_episode_length = max(f_rows.shape[1] for f_rows in f_rows_per_seed)
+    policies = {
+        "natural termination": natural_termination_policy(),
+        f"gesp (t_grace = {args.t_grace})": gesp_policy(round(args.t_grace * max_episode_length)),
+        "constant (50 steps)": constant_policy(50),
+        "wall of death": wall_of_death_policy(),
+    }
+    res_list = replay_policies_seeds(f_rows_per_seed, policies, args.monotone)
+    print("policy, frames evaluated, solutions missed, best f")
+    for name in policies:
+        print(name, np.mean([res[name]["frames_evaluated"] for res in res_list]), np.mean([res[name]["solutions_missed"] for res in res_list]), np.mean([res[name]["anytime_best_f"][-1] for res in res_list]), sep=", ")
@@ -8,11 +8,26 @@ from tqdm import tqdm as tqdm
 from copy import deepcopy
 from termcolor import colored
 import time
+from gesp_replay import replay_tgrace_sweep_seeds
 
 
 
 MAX_TIME_TGRACE_DIFFERENT_VALUES_EXP=1200.0
 
+# Experiments in which the objective value is monotone increasing during an episode.
+MONOTONE_INCREASING_EXPERIMENTS = (
+    "garagegymCartPole-v1",
+    "supermario5-1",
+    "supermario6-2",
+    "supermario6-4",
+    "garagegymAnt-v3",
+    "garagegymHopper-v3",
+    # "garagegymPendulum-v1",
+    # "garagegymHalfCheetah-v3",
+    # "garagegymSwimmer-v3",
+    # "veenstra",
+)
+
 
 
 def exit_after_k():
@@ -257,6 +272,10 @@ class tgrace_exp_figures():
         return comp(wo_gesp_f, w_gesp_f) # with gesp equal or better -> 1.0 
 
 
+    def _is_monotone_increasing(self):
+        return self.experiment_name in MONOTONE_INCREASING_EXPERIMENTS
+
+
     def when2stopGESP(self, f_array, t_grace_proportion):
         assert t_grace_proportion <= 1.0
 
@@ -298,21 +317,7 @@ class tgrace_exp_figures():
         else:
             raise ValueError(f"One of the previous three conditions should be True.\n episode_length_w_gesp = {episode_length_w_gesp}\n episode_length_wo_gesp = {episode_length_wo_gesp}\n max_episode_length = {max_episode_length}\n")
 
-        is_monotone_increasing = False
-        if self.experiment_name in (
-            "garagegymCartPole-v1",
-            "supermario5-1",
-            "supermario6-2",
-            "supermario6-4",
-            "garagegymAnt-v3",
-            "garagegymHopper-v3",
-            # "garagegymPendulum-v1",
-            # "garagegymHalfCheetah-v3",
-            # "garagegymSwimmer-v3",
-            # "veenstra",
-             ):
-            is_monotone_increasing = True
-
+        is_monotone_increasing = self._is_monotone_increasing()
 
         assert is_monotone_increasing or (episode_length_wo_gesp == max_episode_length), f"The environment {self.experiment_name} needs to have either \n1) a monotone increasing f \nor\n2) A constant episode length."
 
@@ -389,6 +394,20 @@ class tgrace_exp_figures():
         return proportion_best_solution_not_missed_list, proportion_frames_evaluated_list, proportion_with_gesp_eq_or_better_list
 
 
+    def get_proportion_timesaved_bestsolsmised_all_tgrace(self, t_grace_proportions, n_jobs=-1):
+        """
+        Same as get_proportion_timesaved_bestsolsmised(lambda x: self.when2stopGESP(x, t_grace)) for every
+        t_grace in t_grace_proportions, but replaying all the values at once (see gesp_replay.py).
+        Returns three arrays of shape (n_seeds, len(t_grace_proportions)).
+        """
+        assert self.combined_df.shape[0] > 2, "Dataframe is empty or has only one row."
+        f_rows_per_seed = [self.combined_df[self.combined_df['seed'] == seed].iloc[:, 2:].to_numpy(dtype=np.float64) for seed in self.seed_list]
+        max_episode_length = f_rows_per_seed[0].shape[1]
+        grace_steps = np.array([round(t_grace * max_episode_length) for t_grace in t_grace_proportions])
+        res_list = replay_tgrace_sweep_seeds(f_rows_per_seed, grace_steps, self._is_monotone_increasing(), n_jobs=n_jobs)
+        return tuple(np.array([res[key] for res in res_list]) for key in ("best_solution_not_missed", "frames_evaluated", "gesp_eq_or_better"))
+
+
     def plot_tgrace_param(self):
         
         x = np.linspace(0.0, 1.0, 101, endpoint=True)
@@ -396,15 +415,11 @@ class tgrace_exp_figures():
         y_frames_median = np.zeros_like(x, dtype=np.float64)
         y_better_median = np.zeros_like(x, dtype=np.float64)
 
-        for i, t_grace in tqdm(list(enumerate(x))):
-            proportion_best_missed_list, proportion_frames_evaluated_list, proportion_with_gesp_worse_list = self.get_proportion_timesaved_bestsolsmised(lambda x: self.when2stopGESP(x, t_grace))
-            if proportion_best_missed_list is None:
-                print("Skipping plot for", env_name, "because applying GESP made no difference.")
-                return
-            x[i] = t_grace
-            y_missed_median[i] = np.mean(proportion_best_missed_list)
-            y_frames_median[i] = np.mean(proportion_frames_evaluated_list)
-            y_better_median[i] = np.mean(proportion_with_gesp_worse_list)
+        proportion_best_missed, proportion_frames_evaluated, proportion_with_gesp_worse = self.get_proportion_timesaved_bestsolsmised_all_tgrace(x)
+        for i, t_grace in enumerate(x):
+            y_missed_median[i] = np.mean(list(proportion_best_missed[:, i]))
+            y_frames_median[i] = np.mean(list(proportion_frames_evaluated[:, i]))
+            y_better_median[i] = np.mean(list(proportion_with_gesp_worse[:, i]))
         plt.figure(figsize=(4, 3) if plot_label == "classic: cart pole" else (4, 2.17))
         plt.ylim(0.0, 1.05)
         plt.plot(x, y_missed_median, linestyle="-", color="#1f77b4", label="best solution not missed")
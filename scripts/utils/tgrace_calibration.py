@@ -0,0 +1,107 @@
+"""
+Pick the grace time of GESP for each task, from the full length curves logged with --tgrace_nokill.
+
+For each task, the smallest t_grace (and tolerance, if more than one is given) whose simulated
+"best solution not missed" rate is at least --target is chosen. Among the tolerances that meet
+the target, the one that evaluates the fewest frames is kept.
+
+    python scripts/utils/tgrace_calibration.py --target 0.95 --tolerances 0 1 5
+
+The result is written to results/data/tgrace_calibration.json, which experiment_*.py --launch_local reads.
+"""
+import json
+import os
+import sys
+
+CALIBRATION_FILE = "results/data/tgrace_calibration.json"
+
+
+
+def load_calibrated_tgrace(task_name:str, default_gracetime:int, max_episode_length:int):
+    """
+    Grace time (in steps of an episode of max_episode_length steps) and tolerance for task_name,
+    or (default_gracetime, 0.0) if the task is not in the calibration file.
+    """
+    if not os.path.exists(CALIBRATION_FILE):
+        return default_gracetime, 0.0
+    with open(CALIBRATION_FILE, "r") as f:
+        calibration = json.load(f)
+    if task_name not in calibration:
+        return default_gracetime, 0.0
+    gracetime = max(1, round(calibration[task_name]["t_grace_proportion"] * max_episode_length))
+    tolerance = calibration[task_name]["tolerance"]
+    print(f"Using calibrated grace time for {task_name}: gracetime = {gracetime}, tolerance = {tolerance}")
+    return gracetime, tolerance
+
+
+
+def calibrate(experiment_name:str, experiment_result_path:str, target:float, tolerances=(0.0,), n_jobs:int=-1):
+    """Returns the calibrated parameters of experiment_name as a dict, or None if no t_grace meets the target."""
+    import numpy as np
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    from gesp_replay import load_nokill_log, replay_tgrace_sweep_seeds
+    from src_tgrace_experiment import tgrace_exp_figures, MONOTONE_INCREASING_EXPERIMENTS
+
+    f_rows_per_seed = [load_nokill_log(path) for path in tgrace_exp_figures._get_filepath_list(experiment_name, experiment_result_path)]
+    max_episode_length = max(f_rows.shape[1] for f_rows in f_rows_per_seed)
+    f_rows_per_seed = [np.pad(f_rows, ((0, 0), (0, max_episode_length - f_rows.shape[1])), constant_values=np.nan) for f_rows in f_rows_per_seed]
+    t_grace_proportions = np.linspace(0.0, 1.0, 101, endpoint=True)
+    grace_steps = np.array([round(t_grace * max_episode_length) for t_grace in t_grace_proportions])
+
+    best = None
+    for tolerance in tolerances:
+        res_list = replay_tgrace_sweep_seeds(f_rows_per_seed, grace_steps, experiment_name in MONOTONE_INCREASING_EXPERIMENTS, n_jobs=n_jobs, tolerance=tolerance)
+        best_solution_not_missed = np.mean([res["best_solution_not_missed"] for res in res_list], axis=0)
+        frames_evaluated = np.mean([res["frames_evaluated"] for res in res_list], axis=0)
+        meets_target = np.where(best_solution_not_missed >= target)[0]
+        if len(meets_target) == 0:
+            continue
+        i = meets_target[0]
+        if best is None or frames_evaluated[i] < best["frames_evaluated"]:
+            best = {
+                "t_grace_proportion": float(t_grace_proportions[i]),
+                "tolerance": float(tolerance),
+                "target": target,
+                "best_solution_not_missed": float(best_solution_not_missed[i]),
+                "frames_evaluated": float(frames_evaluated[i]),
+                "n_seeds": len(f_rows_per_seed),
+            }
+    return best
+
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Calibrate the grace time of GESP for each task.')
+    parser.add_argument('--target', required=True, type=float, help='Minimum proportion of best solutions that are not missed, e.g. 0.95.')
+    parser.add_argument('--tolerances', type=float, nargs='+', default=[0.0], help='Tolerance margins to try.')
+    parser.add_argument('--path', type=str, default="results/data/tgrace_experiment/", help='Directory with the logs of --tgrace_nokill.')
+    parser.add_argument('--tasks', type=str, nargs='+', default=None, help='Tasks to calibrate (prefix of the log files). All the tasks in --path by default.')
+    args = parser.parse_args()
+
+    tasks = args.tasks
+    if tasks is None:
+        tasks = sorted(set(filename.rsplit("_", 1)[0] for filename in os.listdir(args.path) if filename.endswith(".txt")))
+
+    calibration = {}
+    if os.path.exists(CALIBRATION_FILE):
+        with open(CALIBRATION_FILE, "r") as f:
+            calibration = json.load(f)
+
+    for task in tasks:
+        print(f"Calibrating {task}...")
+        try:
+            res = calibrate(task, args.path, args.target, args.tolerances)
+        except (AssertionError, ValueError) as e:
+            print(f"Skipping {task}: {e}")
+            continue
+        if res is None:
+            print(f"No t_grace meets the target {args.target} for {task}.")
+            continue
+        print(res)
+        calibration[task] = res
+
+    with open(CALIBRATION_FILE, "w") as f:
+        json.dump(calibration, f, indent=4)
+    print("Saved in", CALIBRATION_FILE)